@@ -1,30 +1,234 @@
 #!/usr/bin/env python3
 
 import os
+import queue
+import selectors
 import signal
 import socket
+import struct
 import sys
 import time
+from collections import deque
 from datetime import datetime
-from threading import Thread
+from threading import Lock, Thread, current_thread
+import bisect
+import heapq
 import json
+import math
+import zlib
 
-def may_clean_log(file_path):
-    if not os.path.exists(file_path):
-        return
-    file_length = os.path.getsize(file_path)
-    if file_length < 100 * 1024 * 1024:
-        return
+class LogWriter(Thread):
+    # Background log writer. log() only queues records, this thread formats
+    # and writes them in batches and rotates the file by size and/or age,
+    # keeping backup_count old files (path.1 is the newest).
+    BATCH = 512
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, rotate_seconds=0, backup_count=5, echo=False):
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.echo = echo
+        self.records = queue.SimpleQueue()
+        self.file = None
+        self.opened_at = 0
+
+    def put(self, t, msg):
+        self.records.put((t, msg))
+
+    def open_file(self):
+        try:
+            self.file = open(self.path, 'a+')
+        except IOError as e:
+            print("Error opening log file %s: %s" % (self.path, e))
+            self.file = None
+        self.opened_at = time.time()
+
+    def should_rotate(self):
+        if self.file is None:
+            return False
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            return True
+        return self.rotate_seconds and time.time() - self.opened_at >= self.rotate_seconds
+
+    def rotate(self):
+        self.file.close()
+        try:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = "%s.%d" % (self.path, i)
+                if os.path.exists(src):
+                    os.replace(src, "%s.%d" % (self.path, i + 1))
+            if self.backup_count > 0:
+                os.replace(self.path, self.path + ".1")
+            else:
+                os.remove(self.path)
+        except OSError as e:
+            print("Error rotating log file %s: %s" % (self.path, e))
+        self.open_file()
+
+    def next_timeout(self):
+        if not self.rotate_seconds:
+            return None
+        return max(0.0, self.opened_at + self.rotate_seconds - time.time())
+
+    def run(self):
+        self.open_file()
+        if self.should_rotate():
+            self.rotate()
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self.records.get(timeout=self.next_timeout())]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+            if batch:
+                lines = "".join(["%s %s\n" % (str(datetime.fromtimestamp(t)), msg) for t, msg in batch])
+                if self.echo:
+                    print(lines, end="")
+                if self.file is not None:
+                    try:
+                        self.file.write(lines)
+                        self.file.flush()
+                    except IOError:
+                        pass
+            if self.should_rotate():
+                self.rotate()
+        if self.file is not None:
+            self.file.close()
+
+    def stop(self):
+        self.records.put(None)
+        self.join()
+
+#########################################################
+# Traffic capture file, written when capture_path is set:
+#     header  = CAPTURE_MAGIC + start wall time(f64)
+#     record  = time_us(u64) tp_id(u32) length(u32) channel(u8) pad(3) + data
+#     index   = n * (time_us(u64) + file offset(u64)) of every
+#               CAPTURE_INDEX_EVERY-th record
+#     trailer = index offset(u64) + index entries(u64) + CAPTURE_INDEX_MAGIC
+# time_us counts from the capture start and never goes back, so
+# a reader can mmap the file and bisect the index for a time.
+# Index and trailer are written on a clean stop only, readers
+# of a cut short file scan the records instead.
+# channel is CAPTURE_TCP (a received frame, decompressed),
+# CAPTURE_UDP (a received datagram), CAPTURE_CONNECT (data is
+# the client IP) or CAPTURE_CLOSE (no data).
+#########################################################
+CAPTURE_MAGIC = b"ATTOCAP1"
+CAPTURE_INDEX_MAGIC = b"ATTOIDX1"
+CAPTURE_HEADER = struct.Struct("<8sd")
+CAPTURE_RECORD = struct.Struct("<QIIB3x")
+CAPTURE_INDEX_ENTRY = struct.Struct("<QQ")
+CAPTURE_TRAILER = struct.Struct("<QQ8s")
+CAPTURE_INDEX_EVERY = 1024
+CAPTURE_TCP = 0
+CAPTURE_UDP = 1
+CAPTURE_CONNECT = 2
+CAPTURE_CLOSE = 3
+
+class CaptureWriter(Thread):
+    # Background capture writer. put() only queues the record, this thread
+    # packs and writes them in batches.
+    BATCH = 512
+
+    def __init__(self, path):
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.records = queue.SimpleQueue()
+        self.started = time.monotonic()
+        self.last_us = 0
+        self.offset = 0
+        self.count = 0
+        self.index = []
+
+    def put(self, channel, tp_id, data=b""):
+        self.records.put((time.monotonic(), channel, tp_id, data))
+
+    def pack(self, record):
+        t, channel, tp_id, data = record
+        # Records from different threads may be queued slightly out of order
+        self.last_us = max(self.last_us, int((t - self.started) * 1000000))
+        if self.count % CAPTURE_INDEX_EVERY == 0:
+            self.index.append(CAPTURE_INDEX_ENTRY.pack(self.last_us, self.offset))
+        self.count += 1
+        self.offset += CAPTURE_RECORD.size + len(data)
+        return CAPTURE_RECORD.pack(self.last_us, tp_id, len(data), channel) + data
+
+    def run(self):
+        try:
+            f = open(self.path, "wb")
+            f.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time()))
+        except IOError as e:
+            log("Error opening capture file %s: %s" % (self.path, e))
+            f = None
+        self.offset = CAPTURE_HEADER.size
+        log("Capture traffic to %s" % self.path)
+        stopping = False
+        while not stopping:
+            batch = [self.records.get()]
+            while len(batch) < self.BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+            if batch and f is not None:
+                try:
+                    f.write(b"".join([self.pack(record) for record in batch]))
+                except IOError as e:
+                    log("Error writing capture file %s, stop capturing: %s" % (self.path, e))
+                    f.close()
+                    f = None
+        if f is not None:
+            try:
+                f.write(b"".join(self.index))
+                f.write(CAPTURE_TRAILER.pack(self.offset, len(self.index), CAPTURE_INDEX_MAGIC))
+            except IOError as e:
+                log("Error writing capture index %s: %s" % (self.path, e))
+            f.close()
+        log("Captured %d records to %s" % (self.count, self.path))
+
+    def stop(self):
+        self.records.put(None)
+        self.join()
+
+def log_enabled(category, level=1):
+    return LOG_VERBOSITY.get(category, 1) >= level
+
+def load_log_verbosity(file_path):
+    # {"category": level}, 0 silences a category, 2 enables per-message logging
     try:
-        os.remove(file_path)
-    except OSError as e:
-        print(f"Error deleting the file {file_path}: {e}")
+        with open(file_path) as f:
+            LOG_VERBOSITY.update(json.load(f))
+    except (IOError, ValueError) as e:
+        log("Error loading log verbosity from %s: %s" % (file_path, e))
+        return
+    log("Log verbosity: %s" % json.dumps(LOG_VERBOSITY))
 
-def log(msg):
+def log(msg, category="general", level=1):
+    if LOG_VERBOSITY.get(category, 1) < level:
+        return
     # Remove these two lines for debugging
     if len(msg) > 1024:
         msg = msg[:1016] + "[......]"
 
+    if LOG_WRITER is not None:
+        LOG_WRITER.put(time.time(), msg)
+        return
     t_now = datetime.now()
     fmt_msg = "%s %s\n" % (str(t_now), msg)
     try:
@@ -34,71 +238,533 @@ def log(msg):
     except IOError:
         pass
 
+#########################################################
+# Metrics
+#
+# Counters and histograms keyed by name and a tuple of
+# (label, value) pairs, e.g. ("action", "update_status").
+# Gauges are computed by the server when a snapshot is taken.
+# Snapshots go out as the reply of the "stats" action, and
+# as Prometheus text to METRICS_PATH.
+#########################################################
+class Metrics(object):
+    # Histogram bucket upper bounds, one more bucket for +Inf
+    TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+    SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def key(name, labels):
+        # Label values are kept as strings, so keys always sort
+        return (name, tuple((k, v if isinstance(v, str) else str(v)) for k, v in labels))
+
+    def inc(self, name, labels=(), value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=TIME_BUCKETS):
+        key = self.key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # [bounds, bucket counts, count, sum]
+                hist = self.histograms[key] = [buckets, [0] * (len(buckets) + 1), 0, 0]
+            hist[1][bisect.bisect_left(buckets, value)] += 1
+            hist[2] += 1
+            hist[3] += value
+
+    def remove(self, name, labels):
+        with self.lock:
+            self.counters.pop(self.key(name, labels), None)
+
+    def prune(self, label, keep):
+        # Drops the counters whose value of label is not in keep
+        with self.lock:
+            stale = [key for key in self.counters if any(k == label and v not in keep for k, v in key[1])]
+            for key in stale:
+                del self.counters[key]
+
+    @staticmethod
+    def escape(value):
+        # Label value escaping of the Prometheus text format
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @classmethod
+    def series(cls, name, labels):
+        if not labels:
+            return name
+        return "%s{%s}" % (name, ",".join('%s="%s"' % (k, cls.escape(v)) for k, v in labels))
+
+    def snapshot(self, gauges=()):
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, (h[0], list(h[1]), h[2], h[3])) for key, h in self.histograms.items()]
+        snap = {
+            "counters": dict((self.series(*key), v) for key, v in counters),
+            "gauges": dict((self.series(name, labels), v) for name, labels, v in gauges),
+            "histograms": {}
+        }
+        for key, (bounds, buckets, count, total) in histograms:
+            snap["histograms"][self.series(*key)] = {
+                "bounds": list(bounds),
+                "buckets": buckets,
+                "count": count,
+                "sum": total
+            }
+        return snap
+
+    def prometheus_text(self, gauges=(), prefix="atto_"):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (h[0], list(h[1]), h[2], h[3])) for key, h in self.histograms.items())
+        lines = []
+        for (name, labels), v in counters:
+            lines.append("%s %s" % (self.series(prefix + name, labels), v))
+        for name, labels, v in gauges:
+            lines.append("%s %s" % (self.series(prefix + name, labels), v))
+        for (name, labels), (bounds, buckets, count, total) in histograms:
+            cumulative = 0
+            for bound, n in zip(list(bounds) + ["+Inf"], buckets):
+                cumulative += n
+                lines.append("%s %d" % (self.series(prefix + name + "_bucket", labels + (("le", bound),)), cumulative))
+            lines.append("%s %d" % (self.series(prefix + name + "_count", labels), count))
+            lines.append("%s %s" % (self.series(prefix + name + "_sum", labels), total))
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+# First UDP packet a client sends so the server learns its UDP address.
+# UDP_HELLO is the legacy fixed magic, newer clients send
+# UDP_HELLO_PREFIX + token, the token handed out by create_udp_channel.
+# Only the shared UDP mode hands out (and checks) a token, a per client
+# port takes either hello.
+UDP_HELLO = b"010011000111"
+UDP_HELLO_PREFIX = b"atto-hello:"
+
+def is_udp_hello(data_buf):
+    return data_buf == UDP_HELLO or data_buf.startswith(UDP_HELLO_PREFIX)
+
+# Packed UDP datagram, sent by clients that negotiated "udp_pack":
+#     UDP_PACK_MAGIC + n * (length(u16) + payload)
+# It is relayed untouched to "udp_pack" peers and split into its
+# payloads for the others.
+UDP_PACK_MAGIC = b"\xa7P"
+UDP_SUB_HEADER = struct.Struct("<H")
+
+def unpack_udp(data_buf):
+    # Payloads of a packed datagram, None if it isn't a well formed one
+    if not data_buf.startswith(UDP_PACK_MAGIC):
+        return None
+    parts = []
+    pos = len(UDP_PACK_MAGIC)
+    end = len(data_buf)
+    while pos < end:
+        if pos + UDP_SUB_HEADER.size > end:
+            return None
+        (n,) = UDP_SUB_HEADER.unpack_from(data_buf, pos)
+        pos += UDP_SUB_HEADER.size
+        if n == 0 or pos + n > end:
+            return None
+        parts.append(data_buf[pos:pos + n])
+        pos += n
+    return parts or None
+
+# Sequenced UDP datagram, sent by clients that negotiated "udp_seq":
+#     UDP_SEQ_MAGIC + sender_id(u32) + seq(u32) + send_ms(u32) + body
+# body is a plain payload or a packed datagram. sender_id is the sender's
+# tp_id, seq counts its datagrams, send_ms is its clock in ms (both wrap).
+# The server drops datagrams not newer than the last one it relayed from
+# that sender and strips the header for peers without "udp_seq". A packed
+# datagram split for "udp_seq" peers without "udp_pack" keeps the header
+# on every payload, so they get the same seq once per payload.
+UDP_SEQ_MAGIC = b"\xa7S"
+UDP_SEQ_HEADER = struct.Struct("<2sIII")
+
+def seq_newer(seq, last):
+    # Serial number order of 32 bit sequence numbers
+    return 0 < ((seq - last) & 0xFFFFFFFF) < 0x80000000
+
+#########################################################
+# Binary frames, used once a client negotiated "binary".
+# JSON frames always start with "{", binary ones with BIN_MAGIC:
+#     header = magic(u8) opcode(u8) flags(u16) sender_id(u32)
+#     status = scene_id(i32) scene_pos(f64) speed(f32)
+# A status only goes binary when it survives the trip: scene_id written
+# as a plain integer and speed exact as float32, printed back shortest.
+# OP_UPDATE_STATUS goes client -> server (sender_id unused),
+# OP_RIDER_STATUS server -> client with the rider's tp_id.
+#########################################################
+BIN_MAGIC = 0xA7
+BIN_HEADER = struct.Struct("<BBHI")
+BIN_STATUS = struct.Struct("<idf")
+F32 = struct.Struct("<f")
+OP_UPDATE_STATUS = 1
+OP_RIDER_STATUS = 2
+# Tick batch, flags = rider count, body = count * (tp_id(u32) + status)
+OP_RIDER_STATUS_BATCH = 3
+
+# Optional protocol features a client can ask for with "negotiate"
+SERVER_FEATURES = ("binary", "delta", "batch", "compress", "udp_pack", "heartbeat", "udp_seq")
+
+#########################################################
+# Compressed frames, used once a client negotiated "compress".
+# COMPRESSED_FLAG set in the 4 byte length header means the
+# frame body is zlib deflated, the length is the deflated one.
+# Either side only compresses frames of COMPRESS_MIN_BYTES and
+# up, and only when that makes them smaller.
+#########################################################
+COMPRESSED_FLAG = 0x80000000
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+
+def inflate(frame, limit):
+    d = zlib.decompressobj()
+    try:
+        data = d.decompress(frame, limit)
+    except zlib.error as e:
+        raise FrameError("Bad compressed frame: %s" % str(e))
+    if d.unconsumed_tail:
+        raise FrameError("Inflated frame over limit %d" % limit)
+    return data
+
+def f32_str(value):
+    # Shortest decimal that reads back as the same float32
+    value = F32.unpack(F32.pack(value))[0]
+    for digits in range(1, 10):
+        text = "%.*g" % (digits, value)
+        if F32.unpack(F32.pack(float(text)))[0] == value:
+            return text
+    return repr(value)
+
+def status_to_binary(status):
+    # Returns None if the status doesn't fit the numeric binary layout
+    try:
+        scene_id = int(status["scene_id"])
+        speed = float(status["speed"])
+        if str(scene_id) != str(status["scene_id"]) or float(f32_str(speed)) != speed:
+            return None
+        return BIN_STATUS.pack(scene_id, float(status["scene_pos"]), speed)
+    except (KeyError, ValueError, TypeError, OverflowError, struct.error):
+        return None
+
+def binary_to_status(body):
+    scene_id, scene_pos, speed = BIN_STATUS.unpack_from(body)
+    return {
+        "scene_id": str(scene_id),
+        "scene_pos": str(scene_pos),
+        "speed": f32_str(speed)
+    }
+
+class FrameError(Exception):
+    pass
+
+def wake_socket(sock):
+    # Unblocks a thread sitting in recv()/accept() on sock, it sees EOF or an
+    # error right away. Lets blocking I/O threads stop without polling.
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass #Unconnected UDP still wakes up on Linux, or closed already
+
+class FrameDecoder(object):
+    # Reads length prefixed frames with recv_into() into one reusable
+    # bytearray and hands them out as memoryviews, several per read when
+    # they arrived together. A frame view is only valid until the consumer
+    # returns, use bytes(frame) to keep it.
+    def __init__(self, header_len, packet_limit, buf_size=64 * 1024):
+        self.header_len = header_len
+        self.packet_limit = packet_limit
+        self.buf = bytearray(buf_size)
+        self.start = 0
+        self.end = 0
+        self.wanted = header_len
+
+    def recv_from(self, sock):
+        if self.start + self.wanted > len(self.buf) or self.end == len(self.buf):
+            self.make_room()
+        with memoryview(self.buf)[self.end:] as view:
+            n = sock.recv_into(view)
+        self.end += n
+        return n
+
+    def feed(self, data):
+        # Bytes that were read elsewhere, e.g. handed over with a migrated socket
+        if self.end + len(data) > len(self.buf):
+            wanted = self.wanted
+            self.wanted = self.end - self.start + len(data)
+            self.make_room()
+            self.wanted = wanted
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def unread(self):
+        # Received bytes not handed out as frames yet
+        return bytes(self.buf[self.start:self.end])
+
+    def make_room(self):
+        n = self.end - self.start
+        size = max(len(self.buf), self.wanted)
+        if size - n < 4096:
+            size = min(size * 2, self.header_len + self.packet_limit)
+        if size != len(self.buf):
+            buf = bytearray(size)
+            buf[:n] = self.buf[self.start:self.end]
+            self.buf = buf
+        else:
+            self.buf[:n] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = n
+
+    def frames(self):
+        with memoryview(self.buf) as view:
+            while self.end - self.start >= self.header_len:
+                header_end = self.start + self.header_len
+                lens = int.from_bytes(view[self.start:header_end], byteorder="little")
+                compressed = lens & COMPRESSED_FLAG
+                lens &= ~COMPRESSED_FLAG
+                if lens > self.packet_limit:
+                    raise FrameError("Frame length %d over limit" % lens)
+                if header_end + lens > self.end:
+                    self.wanted = self.header_len + lens
+                    break
+                frame = view[header_end:header_end + lens]
+                self.start = header_end + lens
+                self.wanted = self.header_len
+                try:
+                    yield inflate(frame, self.packet_limit) if compressed else frame
+                finally:
+                    frame.release()
+        if self.start == self.end:
+            self.start = self.end = 0
+
+class SlowConsumerError(Exception):
+    pass
+
+class OutboundQueue(object):
+    # Bounded per-client queue of wire frames drained by a writer, so one
+    # stalled client never blocks the thread that fans a message out.
+    # Overflow policies:
+    #     "drop_oldest"   - drop the oldest queued frames
+    #     "latest_status" - frames pushed with a key (the sender of a status
+    #                       update) replace the queued one for that key,
+    #                       otherwise like drop_oldest
+    #     "disconnect"    - raise SlowConsumerError
+    POLICIES = ("drop_oldest", "latest_status", "disconnect")
+    WRITE_BATCH = 64 * 1024
+
+    def __init__(self, policy="latest_status", max_frames=1024, max_bytes=4 * 1024 * 1024):
+        assert policy in self.POLICIES, "Unknown send queue policy: %s" % policy
+        self.policy = policy
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.latest = {}
+        # Keys of keyed frames that were replaced or dropped before being sent
+        self.lost = set()
+        self.head = None
+        self.bytes = 0
+        self.dropped = 0
+        self.idle = True
+        self.lock = Lock()
+
+    def depth(self):
+        return len(self.frames) + (self.head is not None)
+
+    def push(self, frame, key=None):
+        # Returns True if the queue was idle and the writer must be kicked
+        with self.lock:
+            if key is not None and self.policy == "latest_status":
+                entry = self.latest.get(key)
+                if entry is not None:
+                    self.bytes += len(frame) - len(entry[1])
+                    entry[1] = frame
+                    self.dropped += 1
+                    self.lost.add(key)
+                    return False
+            while self.frames and (len(self.frames) >= self.max_frames or
+                                   self.bytes + len(frame) > self.max_bytes):
+                if self.policy == "disconnect":
+                    raise SlowConsumerError("Send queue full (%d frames)" % len(self.frames))
+                self.drop_frame()
+            entry = [key, frame]
+            self.frames.append(entry)
+            self.bytes += len(frame)
+            if key is not None and self.policy == "latest_status":
+                self.latest[key] = entry
+            kick = self.idle
+            self.idle = False
+            return kick
+
+    def pop_frame(self):
+        entry = self.frames.popleft()
+        self.bytes -= len(entry[1])
+        if entry[0] is not None and self.latest.get(entry[0]) is entry:
+            del self.latest[entry[0]]
+        return entry[1]
+
+    def drop_frame(self):
+        entry = self.frames[0]
+        self.pop_frame()
+        self.dropped += 1
+        if entry[0] is not None:
+            self.lost.add(entry[0])
+
+    def take_lost(self, key):
+        # True if a frame for key was lost since the last call
+        if key not in self.lost:
+            return False
+        with self.lock:
+            self.lost.discard(key)
+        return True
+
+    def write_to(self, sock):
+        # One send() of up to WRITE_BATCH bytes, the writer calls it again when
+        # the socket is writable. Returns True once everything is written.
+        if self.head is None:
+            with self.lock:
+                if not self.frames:
+                    self.idle = True
+                    return True
+                batch = [self.pop_frame()]
+                size = len(batch[0])
+                while self.frames and size + len(self.frames[0][1]) <= self.WRITE_BATCH:
+                    batch.append(self.pop_frame())
+                    size += len(batch[-1])
+            self.head = memoryview(b"".join(batch))
+        try:
+            # Thread mode sockets are blocking for their reader, never block the writer
+            sent = sock.send(self.head, socket.MSG_DONTWAIT)
+        except (BlockingIOError, socket.timeout):
+            return False
+        if sent < len(self.head):
+            self.head = self.head[sent:]
+            return False
+        self.head = None
+        with self.lock:
+            if self.frames:
+                return False
+            self.idle = True
+            return True
+
 class TcpConnection(Thread):
     PACKET_LIMIT = 1024 * 1024
     HEADER_LEN = 4
 
-    def __init__(self, socket, client_addr, recv_cb, close_cb):
+    @classmethod
+    def make_frame(cls, data_bytes, compress=False):
+        # Length prefixed wire frame, build it once to share between recipients
+        data_len = len(data_bytes)
+        assert data_len != 0, "Try to send empty string shouldn't happen."
+        if data_len > cls.PACKET_LIMIT:
+            data_len = cls.PACKET_LIMIT
+            data_bytes = data_bytes[:data_len]
+        if compress:
+            deflated = zlib.compress(data_bytes, COMPRESS_LEVEL)
+            if len(deflated) < data_len:
+                METRICS.inc("tcp_compressed_frames_total")
+                METRICS.inc("tcp_compress_saved_bytes_total", (), data_len - len(deflated))
+                return (len(deflated) | COMPRESSED_FLAG).to_bytes(cls.HEADER_LEN, byteorder="little") + deflated
+        return data_len.to_bytes(cls.HEADER_LEN, byteorder="little") + data_bytes
+
+    def __init__(self, socket, client_addr, recv_cb, close_cb, send_queue, writer):
         Thread.__init__(self)
         self.recv_cb = recv_cb
         self.close_cb = close_cb
         self.socket = socket
-        self.socket.settimeout(1)
         self.client_addr = client_addr
+        self.decoder = FrameDecoder(self.HEADER_LEN, self.PACKET_LIMIT)
+        self.send_queue = send_queue
+        # Shared EventLoop thread draining the send queues of all connections
+        self.writer = writer
+        self.writing = False
         self.running = False
 
-    def send_data(self, data_bytes):
-        data_len = len(data_bytes)
-        assert data_len != 0, "Try to send empty string shouldn't happen."
-        if data_len > self.PACKET_LIMIT:
-            data_len = self.PACKET_LIMIT
-            data_bytes = data_bytes[:data_len]
-        header = data_len.to_bytes(self.HEADER_LEN, byteorder="little")
-        self.socket.send(header + data_bytes)
+    def send_data(self, data_bytes, key=None):
+        self.send_frame(self.make_frame(data_bytes), key)
 
-    def recv_data(self):
-        data = bytes([])
-        header = self.socket.recv(self.HEADER_LEN)
-        if not header:
-            return b""
-        lens = int.from_bytes(header, byteorder="little")
-        # Receiving data block
-        n_received = 0
-        while n_received < lens:
-            remaining = lens - n_received
-            buf_len = min(remaining, 4096)
-            data += self.socket.recv(buf_len)
-            n_received = len(data)
-        return data
+    def send_frame(self, frame, key=None):
+        try:
+            kick = self.send_queue.push(frame, key)
+        except SlowConsumerError as e:
+            log("%s, disconnect slow client %s" % (str(e), str(self.client_addr)))
+            self.wake()
+            return
+        METRICS.inc("tcp_out_messages_total")
+        METRICS.inc("tcp_out_bytes_total", (), len(frame))
+        if kick:
+            self.writer.call_soon(self.start_writing)
+
+    def start_writing(self):
+        # Runs on the writer thread
+        if self.socket is None or self.writing:
+            return
+        self.writing = True
+        self.writer.register(self.socket, selectors.EVENT_WRITE, self.on_writable)
+
+    def on_writable(self, mask):
+        try:
+            done = self.send_queue.write_to(self.socket)
+        except Exception as e:
+            log("Socket send exception: %s" % str(e))
+            self.wake()
+            done = True
+        if done:
+            self.writing = False
+            self.writer.unregister(self.socket)
+
+    def release_socket(self):
+        # Runs on the writer thread so the socket leaves its selector first
+        if self.writing:
+            self.writing = False
+            self.writer.unregister(self.socket)
+        self.socket.close()
 
     def run(self):
         self.send_data(b'{"action": "Welcome!", "data":""}') #Debugging purpose
         self.running = True
         while self.running:
             try:
-                data_buf = self.recv_data()
-                if not data_buf:
-                    log("Connnection closed by peer, quit this connection.")
+                if not self.decoder.recv_from(self.socket):
+                    if self.running:
+                        log("Connnection closed by peer, quit this connection.")
                     break
-            except socket.timeout:
-                continue
             except Exception as e:
-                log("Socket recv exception: %s" % str(e))
+                if self.running:
+                    log("Socket recv exception: %s" % str(e))
+                break
+            try:
+                for data_buf in self.decoder.frames():
+                    if self.recv_cb is None:
+                        log("XXX: Discard data due to callback not available")
+                        continue
+                    # Like the EventLoop, a failing handler costs the frame,
+                    # not the reader, or close_cb would never run
+                    try:
+                        self.recv_cb(data_buf)
+                    except Exception as e:
+                        log("TcpConnection handler exception: %s" % str(e))
+            except FrameError as e:
+                log("Bad frame, quit this connection: %s" % str(e))
                 break
-            else:
-                if self.recv_cb is not None:
-                    self.recv_cb(data_buf)
-                else:
-                    log("XXX: Discard data due to callback not available")
 
         log("TcpConnection exit.")
-        self.socket.close()
-        self.socket = None
+        self.writer.call_soon(self.release_socket)
         self.close_cb()
 
-    def stop(self):
+    def wake(self):
+        # Ends run() without waiting for it, safe from any thread
         self.running = False
-        #TODO: wait up to 1 second until thread quit
+        wake_socket(self.socket)
+
+    def stop(self):
+        self.wake()
+        if current_thread() is not self and self.is_alive():
+            self.join()
 
 class UdpConnection(Thread):
     PACKET_LIMIT = 1472
@@ -109,11 +775,14 @@ class UdpConnection(Thread):
         self.close_cb = close_cb
         self.socket = socket
         self.client_addr = None
+        # (sendto, addr) used by the batched relay once the addr is known
+        self.target = None
         self.running = False
 
     def send_data(self, data_bytes):
         if self.client_addr is None:
-            #log("XXX: Don't know client UDP addr yet, discard sending")
+            if log_enabled("udp", 2):
+                log("XXX: Don't know client UDP addr yet, discard sending", "udp", 2)
             return
         data_len = len(data_bytes)
         assert data_len != 0, "Try to send empty string shouldn't happen."
@@ -129,6 +798,7 @@ class UdpConnection(Thread):
         if self.client_addr is None:
             log("Received first UDP data, save addr %s" % str(addr))
             self.client_addr = addr
+            self.target = (self.socket.sendto, addr)
         return data
 
     def run(self):
@@ -137,34 +807,552 @@ class UdpConnection(Thread):
             try:
                 data_buf = self.recv_data()
                 if not data_buf:
-                    log("Connnection closed by peer, quit this connection.")
+                    if self.running:
+                        log("Connnection closed by peer, quit this connection.")
                     break
-            except socket.timeout:
-                continue
             except Exception as e:
-                log("Socket recv exception: %s" % str(e))
+                if self.running:
+                    log("Socket recv exception: %s" % str(e))
                 break
             else:
-                if data_buf == b"010011000111":
-                    pass #Hacking, first package for telling server the client udp address
+                if is_udp_hello(data_buf):
+                    pass #First package for telling server the client udp address
                 else:
                     if self.recv_cb is not None:
-                        self.recv_cb(data_buf)
+                        try:
+                            self.recv_cb(data_buf)
+                        except Exception as e:
+                            log("UdpConnection handler exception: %s" % str(e))
                     else:
                         log("XXX: Discard data due to callback not available")
 
         log("UdpConnection exit.")
+        self.target = None
         self.socket.close()
         self.socket = None
         self.close_cb()
 
     def stop(self):
         self.running = False
-        #TODO: wait up to 1 second until thread quit
+        wake_socket(self.socket)
+        if current_thread() is not self and self.is_alive():
+            self.join()
+
+#########################################################
+# Event loop serving mode
+#
+# One EventLoop thread multiplexes the listening socket and
+# every client TCP/UDP socket with selectors (epoll on Linux),
+# instead of two blocking threads per client. All callbacks
+# run on the loop thread, other threads hand work over with
+# call_soon().
+#########################################################
+class EventLoop(Thread):
+    def __init__(self):
+        Thread.__init__(self)
+        self.selector = selectors.DefaultSelector()
+        self.pending = deque()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, self.on_wakeup)
+        # Heap of [when, seq, func, args], func set to None when cancelled
+        self.timers = []
+        self.timer_seq = 0
+        self.running = False
+
+    def register(self, sock, events, handler):
+        self.selector.register(sock, events, handler)
+
+    def modify(self, sock, events, handler):
+        self.selector.modify(sock, events, handler)
+
+    def unregister(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def call_soon(self, func, *args):
+        # Safe to call from any thread
+        self.pending.append((func, args))
+        try:
+            self.wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def call_later(self, delay, func, *args):
+        # Loop thread only, use call_soon() to get there from other threads
+        self.timer_seq += 1
+        timer = [time.monotonic() + delay, self.timer_seq, func, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        timer[2] = None
+
+    def run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            when, seq, func, args = heapq.heappop(self.timers)
+            if func is None:
+                continue
+            try:
+                func(*args)
+            except Exception as e:
+                log("EventLoop timer exception: %s" % str(e))
+
+    def select_timeout(self):
+        if self.pending:
+            return 0
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - time.monotonic())
+
+    def on_wakeup(self, mask):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run_pending(self):
+        while self.pending:
+            func, args = self.pending.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                log("EventLoop callback exception: %s" % str(e))
+
+    def run(self):
+        self.running = True
+        while self.running:
+            for key, mask in self.selector.select(self.select_timeout()):
+                try:
+                    key.data(mask)
+                except Exception as e:
+                    log("EventLoop handler exception: %s" % str(e))
+            self.run_pending()
+            self.run_timers()
+
+        log("EventLoop exit.")
+        self.selector.unregister(self.wakeup_r)
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+        self.selector.close()
+
+    def halt(self):
+        self.running = False
+
+    def stop(self):
+        self.call_soon(self.halt)
+
+class TimerWheel(object):
+    # Hashed timing wheel for many coarse timeouts: add() is O(1), advance()
+    # only touches the slots of the ticks that passed. An entry due more than
+    # one revolution ahead waits in its slot for the right round.
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = [[] for i in range(slots)]
+        self.current = int(time.monotonic() / tick)
+
+    def add(self, when, item):
+        # when is a time.monotonic() value
+        due = max(int(math.ceil(when / self.tick)), self.current + 1)
+        self.slots[due % len(self.slots)].append((due, item))
+
+    def advance(self, now):
+        # Items due by now, each handed out once
+        expired = []
+        target = int(now / self.tick)
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            if not slot:
+                continue
+            waiting = []
+            for entry in slot:
+                if entry[0] <= self.current:
+                    expired.append(entry[1])
+                else:
+                    waiting.append(entry)
+            slot[:] = waiting
+        return expired
+
+class TokenBucket(object):
+    # rate tokens per second, at most burst of them saved up
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def take(self, now):
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens >= 1.0:
+            self.tokens = tokens - 1.0
+            return True
+        self.tokens = tokens
+        return False
+
+    def wait_time(self):
+        # Seconds until take() succeeds again
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+class LoopTcpConnection(object):
+    PACKET_LIMIT = TcpConnection.PACKET_LIMIT
+    HEADER_LEN = TcpConnection.HEADER_LEN
+
+    def __init__(self, loop, socket, client_addr, recv_cb, close_cb, send_queue):
+        self.loop = loop
+        self.recv_cb = recv_cb
+        self.close_cb = close_cb
+        self.socket = socket
+        self.socket.setblocking(False)
+        self.client_addr = client_addr
+        self.decoder = FrameDecoder(self.HEADER_LEN, self.PACKET_LIMIT)
+        self.send_queue = send_queue
+        self.events = selectors.EVENT_READ
+        self.detach_cb = None
+        self.running = False
+
+    def start(self, welcome=True):
+        self.running = True
+        self.loop.register(self.socket, self.events, self.on_events)
+        if welcome:
+            self.send_data(b'{"action": "Welcome!", "data":""}') #Debugging purpose
+
+    def feed(self, data_bytes):
+        # Frames read by the previous owner of a migrated socket
+        self.decoder.feed(data_bytes)
+        self.dispatch_frames()
+
+    def detach(self, detach_cb):
+        # Stop reading, write out what is queued, then hand the socket and the
+        # bytes read but not dispatched to detach_cb(socket, unread) instead of
+        # closing it. Nothing new is queued meanwhile.
+        self.running = False
+        self.detach_cb = detach_cb
+        self.update_events(self.send_queue.depth() == 0)
+
+    def finish_detach(self):
+        sock = self.socket
+        self.loop.unregister(sock)
+        self.socket = None
+        self.detach_cb(sock, self.decoder.unread())
+
+    def send_data(self, data_bytes, key=None):
+        self.send_frame(TcpConnection.make_frame(data_bytes), key)
+
+    def send_frame(self, frame, key=None):
+        if not self.running:
+            return
+        try:
+            kick = self.send_queue.push(frame, key)
+        except SlowConsumerError as e:
+            log("%s, disconnect slow client %s" % (str(e), str(self.client_addr)))
+            self.close()
+            return
+        METRICS.inc("tcp_out_messages_total")
+        METRICS.inc("tcp_out_bytes_total", (), len(frame))
+        if kick:
+            self.flush()
+
+    def flush(self):
+        try:
+            done = self.send_queue.write_to(self.socket)
+        except Exception as e:
+            log("Socket send exception: %s" % str(e))
+            self.close()
+            return
+        self.update_events(done)
+
+    def update_events(self, done):
+        if self.detach_cb is not None:
+            if done:
+                self.finish_detach()
+                return
+            events = selectors.EVENT_WRITE
+        else:
+            events = selectors.EVENT_READ
+            if not done:
+                events |= selectors.EVENT_WRITE
+        if events != self.events:
+            self.events = events
+            self.loop.modify(self.socket, events, self.on_events)
+
+    def on_events(self, mask):
+        if self.socket is None:
+            return
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        if mask & selectors.EVENT_READ and self.running:
+            self.on_readable()
+
+    def on_readable(self):
+        try:
+            if not self.decoder.recv_from(self.socket):
+                log("Connnection closed by peer, quit this connection.")
+                self.close()
+                return
+        except BlockingIOError:
+            return
+        except Exception as e:
+            log("Socket recv exception: %s" % str(e))
+            self.close()
+            return
+        self.dispatch_frames()
+
+    def dispatch_frames(self):
+        # Stop right after a frame that closed or detached the connection,
+        # asking frames() for the next one would consume it from unread()
+        if not self.running:
+            return
+        try:
+            for data_buf in self.decoder.frames():
+                if self.recv_cb is not None:
+                    self.recv_cb(data_buf)
+                else:
+                    log("XXX: Discard data due to callback not available")
+                if not self.running:
+                    break
+        except FrameError as e:
+            log("Bad frame, quit this connection: %s" % str(e))
+            self.close()
+
+    def close(self):
+        if self.socket is None:
+            return
+        log("LoopTcpConnection exit.")
+        self.running = False
+        self.loop.unregister(self.socket)
+        self.socket.close()
+        self.socket = None
+        self.close_cb()
+
+    def stop(self):
+        self.close()
+
+class LoopUdpConnection(object):
+    PACKET_LIMIT = UdpConnection.PACKET_LIMIT
+    # Datagrams drained per readable event before going back to select()
+    DRAIN_LIMIT = 64
+
+    def __init__(self, loop, socket, recv_cb, close_cb):
+        self.loop = loop
+        self.recv_cb = recv_cb
+        self.close_cb = close_cb
+        self.socket = socket
+        self.socket.setblocking(False)
+        self.client_addr = None
+        self.target = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.loop.register(self.socket, selectors.EVENT_READ, self.on_events)
+
+    def send_data(self, data_bytes):
+        if self.client_addr is None or self.socket is None:
+            return
+        data_len = len(data_bytes)
+        assert data_len != 0, "Try to send empty string shouldn't happen."
+        if data_len > self.PACKET_LIMIT:
+            data_len = self.PACKET_LIMIT
+            data_bytes = data_bytes[:data_len]
+        try:
+            self.socket.sendto(data_bytes, self.client_addr)
+        except BlockingIOError:
+            pass #Socket buffer full, drop like the network would
+
+    def on_events(self, mask):
+        for _ in range(self.DRAIN_LIMIT):
+            if self.socket is None:
+                return
+            try:
+                data_buf, addr = self.socket.recvfrom(self.PACKET_LIMIT)
+            except BlockingIOError:
+                return
+            except Exception as e:
+                log("Socket recv exception: %s" % str(e))
+                self.close()
+                return
+            if self.client_addr is None:
+                log("Received first UDP data, save addr %s" % str(addr))
+                self.client_addr = addr
+                self.target = (self.socket.sendto, addr)
+            if is_udp_hello(data_buf):
+                pass #First package for telling server the client udp address
+            elif data_buf:
+                if self.recv_cb is not None:
+                    self.recv_cb(data_buf)
+                else:
+                    log("XXX: Discard data due to callback not available")
+
+    def close(self):
+        if self.socket is None:
+            return
+        log("LoopUdpConnection exit.")
+        self.running = False
+        self.target = None
+        self.loop.unregister(self.socket)
+        self.socket.close()
+        self.socket = None
+        self.close_cb()
+
+    def stop(self):
+        self.close()
+
+#########################################################
+# Shared UDP mode
+#
+# The server owns a single UDP socket. Datagrams are matched
+# to their Transport by source address, which is learned from
+# the hello packet carrying the token handed out in the
+# create_udp_channel reply. Each Transport gets a UdpPeer in
+# place of its own UdpConnection.
+#########################################################
+class UdpPeer(object):
+    PACKET_LIMIT = UdpConnection.PACKET_LIMIT
+
+    def __init__(self, channel, tp, token):
+        self.channel = channel
+        self.tp = tp
+        self.token = token
+        self.client_addr = None
+        self.target = None
+
+    def send_data(self, data_bytes):
+        if self.client_addr is None:
+            return
+        data_len = len(data_bytes)
+        assert data_len != 0, "Try to send empty string shouldn't happen."
+        if data_len > self.PACKET_LIMIT:
+            data_len = self.PACKET_LIMIT
+            data_bytes = data_bytes[:data_len]
+        self.channel.send_to(data_bytes, self.client_addr)
+
+    def stop(self):
+        self.target = None
+        self.channel.remove_peer(self)
+
+class SharedUdpChannel(object):
+    PACKET_LIMIT = UdpConnection.PACKET_LIMIT
+    DRAIN_LIMIT = LoopUdpConnection.DRAIN_LIMIT
+
+    def __init__(self, port, loop=None):
+        self.port = port
+        self.loop = loop
+        self.socket = None
+        self.thread = None
+        self.tokens = {}
+        self.addrs = {}
+        self.running = False
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("", self.port))
+        log("UDP shared channel at port %d" % self.port)
+        self.running = True
+        if self.loop is None:
+            self.thread = Thread(target=self.run)
+            self.thread.start()
+        else:
+            self.socket.setblocking(False)
+            self.loop.register(self.socket, selectors.EVENT_READ, self.on_events)
+
+    def add_peer(self, tp):
+        token = os.urandom(8).hex()
+        peer = UdpPeer(self, tp, token)
+        self.tokens[token] = peer
+        return peer
+
+    def remove_peer(self, peer):
+        self.tokens.pop(peer.token, None)
+        if peer.client_addr is not None and self.addrs.get(peer.client_addr) is peer:
+            del self.addrs[peer.client_addr]
+
+    def send_to(self, data_bytes, addr):
+        try:
+            self.socket.sendto(data_bytes, addr)
+        except BlockingIOError:
+            pass #Socket buffer full, drop like the network would
+        except (OSError, AttributeError) as e:
+            log("UDP shared channel send exception: %s" % str(e))
+
+    def on_datagram(self, data_buf, addr):
+        peer = self.addrs.get(addr)
+        if peer is not None:
+            if not is_udp_hello(data_buf):
+                peer.tp.on_udp_data_recv_callback(data_buf)
+            return
+        if not data_buf.startswith(UDP_HELLO_PREFIX):
+            return #Unknown sender, or legacy hello without token
+        token = data_buf[len(UDP_HELLO_PREFIX):].decode(errors="replace")
+        peer = self.tokens.get(token)
+        if peer is None:
+            log("UDP hello with unknown token from %s, ignored" % str(addr))
+            return
+        if peer.client_addr is not None:
+            # Client address changed (e.g. NAT rebinding), forget the old one
+            self.addrs.pop(peer.client_addr, None)
+        log("Received UDP hello from client %d, save addr %s" % (peer.tp.tp_id, str(addr)))
+        peer.client_addr = addr
+        peer.target = (self.socket.sendto, addr)
+        self.addrs[addr] = peer
+
+    def on_events(self, mask):
+        recvfrom = self.socket.recvfrom
+        for _ in range(self.DRAIN_LIMIT):
+            try:
+                data_buf, addr = recvfrom(self.PACKET_LIMIT)
+            except BlockingIOError:
+                return
+            except Exception as e:
+                log("UDP shared channel recv exception: %s" % str(e))
+                return
+            if data_buf:
+                self.on_datagram(data_buf, addr)
+
+    def run(self):
+        while self.running:
+            try:
+                data_buf, addr = self.socket.recvfrom(self.PACKET_LIMIT)
+            except Exception as e:
+                if self.running:
+                    log("UDP shared channel recv exception: %s" % str(e))
+                continue
+            if data_buf:
+                try:
+                    self.on_datagram(data_buf, addr)
+                except Exception as e:
+                    log("UDP shared channel handler exception: %s" % str(e))
+
+        log("UDP shared channel exit.")
+        self.socket.close()
+        self.socket = None
+
+    def stop(self):
+        self.running = False
+        if self.loop is None:
+            wake_socket(self.socket)
+            if self.thread is not None and current_thread() is not self.thread:
+                self.thread.join()
+        elif self.socket is not None:
+            self.loop.unregister(self.socket)
+            self.socket.close()
+            self.socket = None
 
 class Transport(object):
-    def __init__(self, tp_id, tcp_socket, tcp_addr, tcp_recv_cb, udp_recv_cb, tp_close_cb):
+    def __init__(self, tp_id, tcp_socket, tcp_addr, tcp_recv_cb, udp_recv_cb, tp_close_cb, loop=None, scene_change_cb=None,
+                 send_queue=None, writer=None):
         self.tp_id = tp_id;
+        self.loop = loop
+        self.writer = writer
+        self.scene_change_cb = scene_change_cb
+        self.send_queue = send_queue if send_queue is not None else OutboundQueue()
         self.tcp_conn = None
         self.udp_conn = None
         self.tcp_socket = tcp_socket
@@ -174,7 +1362,32 @@ class Transport(object):
         self.tp_close_cb = tp_close_cb
         self.client_info = {}
         self.client_info_init()
+        # Bumped on update_user so binary peers know when to refresh rider_info
+        self.user_version = 0
+        self.features = set()
+        # tp_id -> user_version of the rider_info this (binary) client has seen
+        self.known_riders = {}
+        # Last status fields sent out, and its sequence number, for delta peers
+        self.last_status = {}
+        self.status_seq = 0
+        # tp_id -> (status_seq, user_version) this (delta) client has seen
+        self.known_status = {}
+        # scene_pos in the server's scene index, and the last status sent scene-wide
+        self.aoi_pos = 0.0
+        self.far_status_time = 0.0
+        # time.monotonic() of the last TCP frame, idle "heartbeat" clients are reaped
+        self.last_recv = time.monotonic()
+        self.idle_watched = False
+        # Rate limit buckets by action, and the latest throttled status waiting to go out
+        self.buckets = {}
+        self.deferred_status = None
+        # Held while a status is applied, so a deferred one taken by the tick
+        # thread can't go out after a newer one from the reader (thread mode)
+        self.status_lock = Lock()
+        # Sequence number of the last "udp_seq" datagram relayed from this client
+        self.udp_seq = None
         self.closed = False
+        self.stop_lock = Lock()
 
     def client_info_init(self):
         self.client_info["user_id"]     = "N/A"
@@ -189,16 +1402,32 @@ class Transport(object):
         self.client_info["user_id"]     = ui["user_id"]
         self.client_info["user_name"]   = ui["user_name"]
         self.client_info["user_domain"] = ui["user_domain"]
+        self.user_version += 1
 
-    def update_status(self, status_str):
-        status = json.loads(status_str)
+    def update_status(self, status):
+        old_scene = self.client_info["scene_id"]
         self.client_info["scene_id"]    = status["scene_id"]
         self.client_info["scene_pos"]   = status["scene_pos"]
         self.client_info["speed"]       = status["speed"]
+        if self.scene_change_cb is not None and old_scene != status["scene_id"]:
+            self.scene_change_cb(self, old_scene, status["scene_id"])
 
-    def start(self):
-        self.tcp_conn = TcpConnection(self.tcp_socket, self.tcp_addr, self.on_tcp_data_recv_callback, self.on_tcp_close_cb)
-        self.tcp_conn.start()
+    def start(self, welcome=True):
+        if self.loop is None:
+            self.tcp_conn = TcpConnection(self.tcp_socket, self.tcp_addr, self.on_tcp_data_recv_callback, self.on_tcp_close_cb,
+                                          self.send_queue, self.writer)
+            self.tcp_conn.start()
+        else:
+            self.tcp_conn = LoopTcpConnection(self.loop, self.tcp_socket, self.tcp_addr, self.on_tcp_data_recv_callback, self.on_tcp_close_cb,
+                                              self.send_queue)
+            self.tcp_conn.start(welcome)
+
+    def start_udp(self, udp_socket):
+        if self.loop is None:
+            self.udp_conn = UdpConnection(udp_socket, self.on_udp_data_recv_callback, self.on_udp_close_cb)
+        else:
+            self.udp_conn = LoopUdpConnection(self.loop, udp_socket, self.on_udp_data_recv_callback, self.on_udp_close_cb)
+        self.udp_conn.start()
 
     def on_tcp_data_recv_callback(self, data_bytes):
         self.tcp_recv_cb(self, data_bytes)
@@ -206,30 +1435,54 @@ class Transport(object):
     def on_udp_data_recv_callback(self, data_bytes):
         self.udp_recv_cb(self, data_bytes)
 
-    def send_tcp_data(self, data):
+    def wants_compressed(self, data_len):
+        return data_len >= COMPRESS_MIN_BYTES and "compress" in self.features
+
+    def send_tcp_data(self, data, key=None):
+        if self.tcp_conn is None:
+            log("XXX: tcp_conn is none is not right.")
+            return
+        if self.wants_compressed(len(data)):
+            self.tcp_conn.send_frame(TcpConnection.make_frame(data, True), key)
+        else:
+            self.tcp_conn.send_data(data, key)
+
+    def send_tcp_frame(self, frame, key=None):
         if self.tcp_conn is None:
             log("XXX: tcp_conn is none is not right.")
             return
-        self.tcp_conn.send_data(data)
+        self.tcp_conn.send_frame(frame, key)
+
+    def get_send_queue_depth(self):
+        return self.send_queue.depth()
 
     def send_udp_data(self, data):
         if self.udp_conn is None:
-            #log("Warning: No Udp connection for this tp client, skip sending data to it.")
+            if log_enabled("udp", 2):
+                log("Warning: No Udp connection for this tp client, skip sending data to it.", "udp", 2)
             return
         self.udp_conn.send_data(data)
 
+    def drop(self):
+        # Disconnect without waiting for the connection threads, the
+        # TCP thread tears the rest down when its recv() wakes up
+        if self.loop is None and self.tcp_conn is not None:
+            self.tcp_conn.wake()
+        else:
+            self.stop()
+
     def on_tcp_close_cb(self):
-        if self.closed:
-            return
         self.stop()
 
     def on_udp_close_cb(self):
-        if self.closed:
-            return
         self.stop()
 
     def stop(self):
-        self.closed = True
+        # TCP and UDP threads may both get here, and each joins the other
+        with self.stop_lock:
+            if self.closed:
+                return
+            self.closed = True
         if self.tcp_conn is not None:
             self.tcp_conn.stop()
             self.tcp_conn = None
@@ -239,11 +1492,14 @@ class Transport(object):
         self.tp_close_cb(self)
 
 class CommServerListener(Thread):
-    def __init__(self, ip, port, new_connect_cb):
+    def __init__(self, ip, port, new_connect_cb, backlog=1024):
         Thread.__init__(self)
         self.ip = ip
         self.port = port
         self.new_connect_cb = new_connect_cb
+        # Room for a reconnect storm, the kernel caps it at net.core.somaxconn
+        self.backlog = backlog
+        self.server_socket = None
         self.running = True
 
     def run(self):
@@ -258,8 +1514,7 @@ class CommServerListener(Thread):
                 continue
             try:
                 server_socket.bind((self.ip, self.port))
-                server_socket.listen(2)
-                server_socket.settimeout(1)
+                server_socket.listen(self.backlog)
                 listen_ip = self.ip
                 if listen_ip == "":
                     listen_ip = "*"
@@ -270,15 +1525,19 @@ class CommServerListener(Thread):
                 server_socket = None
                 continue
             break
+        self.server_socket = server_socket
+        if not self.running:
+            wake_socket(server_socket)
 
         # 2. Server socket keep listening and accepting client connections
         while self.running:
             try:
                 client_sock, client_addr = server_socket.accept()
-            except socket.timeout:
-                pass
-            except:
-                raise
+            except OSError as e:
+                if self.running:
+                    log("Accept exception: %s" % str(e))
+                    time.sleep(0.1) #e.g. out of fds, don't spin
+                continue
             else:
                 log("Accept connection from: %s" % '.'.join(map(str, client_addr)))
                 self.new_connect_cb(client_sock, client_addr)
@@ -289,33 +1548,470 @@ class CommServerListener(Thread):
     def stop(self):
         log("Stop communication server listener.")
         self.running = False
+        wake_socket(self.server_socket)
+        if current_thread() is not self and self.is_alive():
+            self.join()
+
+class LoopServerListener(object):
+    # Connections accepted per readiness event, the rest wait for the next loop pass
+    ACCEPT_BATCH = 64
+
+    def __init__(self, loop, ip, port, new_connect_cb, reuse_port=False, backlog=1024):
+        self.loop = loop
+        self.ip = ip
+        self.port = port
+        self.new_connect_cb = new_connect_cb
+        # Several worker processes listen on the same port, the kernel spreads connections
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.server_socket = None
+
+    def start(self):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((self.ip, self.port))
+        server_socket.listen(self.backlog)
+        server_socket.setblocking(False)
+        listen_ip = self.ip
+        if listen_ip == "":
+            listen_ip = "*"
+        log("TCP listening at : %s:%d (event loop)" % (listen_ip, self.port))
+        self.server_socket = server_socket
+        self.loop.register(server_socket, selectors.EVENT_READ, self.on_events)
+
+    def on_events(self, mask):
+        for _ in range(self.ACCEPT_BATCH):
+            try:
+                client_sock, client_addr = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log("Accept exception: %s" % str(e))
+                return
+            log("Accept connection from: %s" % '.'.join(map(str, client_addr)))
+            self.new_connect_cb(client_sock, client_addr)
+
+    def stop(self):
+        log("Stop communication server listener.")
+        if self.server_socket is not None:
+            self.loop.unregister(self.server_socket)
+            self.server_socket.close()
+            self.server_socket = None
+
+def status_pos(status):
+    # NaN or inf would break the SceneIndex ordering, treat them as unset
+    try:
+        pos = float(status["scene_pos"])
+    except (KeyError, ValueError, TypeError):
+        return 0.0
+    return pos if math.isfinite(pos) else 0.0
+
+def status_scene_id(status):
+    # scene_id is a key of scenes, take scalars as their string and nothing else
+    scene_id = status.get("scene_id") if isinstance(status, dict) else None
+    if isinstance(scene_id, str):
+        return scene_id
+    if isinstance(scene_id, (int, float)):
+        return str(scene_id)
+    return None
+
+class SceneIndex(object):
+    # Riders of one scene sorted by scene_pos, for neighbour range queries.
+    # Not locked itself, the server holds scene_lock around every call.
+    def __init__(self):
+        self.keys = []
+        self.riders = []
+
+    def __len__(self):
+        return len(self.riders)
+
+    def add(self, tp, pos):
+        key = (pos, tp.tp_id)
+        i = bisect.bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.riders.insert(i, tp)
+
+    def remove(self, tp, pos):
+        i = bisect.bisect_left(self.keys, (pos, tp.tp_id))
+        if i < len(self.keys) and self.riders[i] is tp:
+            del self.keys[i]
+            del self.riders[i]
+
+    def move(self, tp, old_pos, new_pos):
+        self.remove(tp, old_pos)
+        self.add(tp, new_pos)
+
+    def query(self, lo, hi):
+        i = bisect.bisect_left(self.keys, (lo,))
+        j = bisect.bisect_right(self.keys, (hi, float("inf")))
+        return self.riders[i:j]
+
+class Roster(object):
+    # Snapshot of the connected clients for list_clients, sorted by tp_id.
+    # Each entry is JSON encoded once, pages are joined from the encoded
+    # strings. Rebuilt only when membership or user info changed, so
+    # scene_pos and speed are appended to the entries when a page is built.
+    def __init__(self, clients):
+        clients = sorted(clients, key=lambda tp: tp.tp_id)
+        self.clients = clients
+        self.tp_ids = []
+        self.entries = []
+        self.by_scene = {}
+        self.by_domain = {}
+        for tp in clients:
+            info = {
+                "tp_id": tp.tp_id,
+                "user_id": tp.client_info["user_id"],
+                "user_name": tp.client_info["user_name"],
+                "user_domain": tp.client_info["user_domain"],
+                "scene_id": tp.client_info["scene_id"]
+            }
+            i = len(self.entries)
+            self.tp_ids.append(tp.tp_id)
+            self.entries.append(json.dumps(info)[:-1])
+            self.by_scene.setdefault(info["scene_id"], []).append(i)
+            self.by_domain.setdefault(info["user_domain"], []).append(i)
+
+    def page(self, scene_id=None, user_domain=None, cursor=None, limit=200, max_bytes=512 * 1024):
+        # (encoded entries, next cursor or None) of the clients after cursor
+        if scene_id is not None:
+            indexes = self.by_scene.get(scene_id, [])
+            if user_domain is not None:
+                domain = set(self.by_domain.get(user_domain, []))
+                indexes = [i for i in indexes if i in domain]
+        elif user_domain is not None:
+            indexes = self.by_domain.get(user_domain, [])
+        else:
+            indexes = None
+        start = 0
+        if cursor is not None:
+            if indexes is None:
+                start = bisect.bisect_right(self.tp_ids, cursor)
+            else:
+                start = bisect.bisect_right(indexes, bisect.bisect_right(self.tp_ids, cursor) - 1)
+        total = len(self.entries) if indexes is None else len(indexes)
+        out = []
+        size = 0
+        pos = start
+        while pos < total and len(out) < limit:
+            i = pos if indexes is None else indexes[pos]
+            info = self.clients[i].client_info
+            entry = '%s, "scene_pos": %s, "speed": %s}' % (self.entries[i], json.dumps(info["scene_pos"]),
+                                                           json.dumps(info["speed"]))
+            if out and size + len(entry) > max_bytes:
+                break
+            out.append(entry)
+            size += len(entry) + 1
+            pos += 1
+        next_cursor = None
+        if pos < total:
+            next_cursor = self.tp_ids[pos - 1 if indexes is None else indexes[pos - 1]]
+        return out, next_cursor
 
 class TransportServer(object):
-    def __init__(self, svr_ip, svr_port):
-        self.udp_port = 30000
+    SERVING_MODES = ("thread", "loop")
+    UDP_MODES = ("per_client", "shared")
+    # Unread bytes per inbox datagram of a migrating client, and how long to
+    # wait for room in the inbox of the owner
+    MIGRATION_CHUNK = 32 * 1024
+    MIGRATION_TIMEOUT = 1.0
+    # Actions with their own metric labels, the rest are counted as "other"
+    ACTIONS = ("binary", "create_udp_channel", "update_user", "update_status", "list_clients",
+               "broadcast", "negotiate", "stats", "ping")
+    # Clients per list_clients page, by default and at most
+    ROSTER_PAGE = 200
+    ROSTER_PAGE_MAX = 1000
+    # Counters labelled by scene_id, kept for scenes with members only
+    SCENE_COUNTERS = ("scene_messages_total", "scene_fanout_total")
+
+    def __init__(self, svr_ip, svr_port, serving_mode="thread", udp_mode="per_client", udp_shared_port=30000,
+                 send_queue_policy="latest_status", send_queue_frames=1024, send_queue_bytes=4 * 1024 * 1024,
+                 status_tick_hz=0, aoi_radius=0, aoi_far_interval=1.0,
+                 worker_id=0, workers=1, worker_inboxes=None, idle_timeout=30,
+                 listen_backlog=1024, max_clients=0, max_clients_per_ip=0, rate_limits=None, capture_path=None):
+        assert serving_mode in self.SERVING_MODES, "Unknown serving mode: %s" % serving_mode
+        assert workers == 1 or serving_mode == "loop", "Multiple workers need the loop serving mode"
+        assert udp_mode in self.UDP_MODES, "Unknown udp mode: %s" % udp_mode
+        assert send_queue_policy in OutboundQueue.POLICIES, "Unknown send queue policy: %s" % send_queue_policy
+        self.svr_ip = svr_ip
+        self.svr_port = svr_port
+        self.serving_mode = serving_mode
+        self.udp_mode = udp_mode
+        self.udp_shared_port = udp_shared_port
+        self.send_queue_policy = send_queue_policy
+        self.send_queue_frames = send_queue_frames
+        self.send_queue_bytes = send_queue_bytes
+        self.udp_channel = None
+        self.loop = None
+        self.writer = None
+        # Status aggregation, 0 sends every update_status right away
+        self.status_tick_hz = status_tick_hz
+        self.tick_loop = None
+        self.pending_status = {}
+        self.pending_lock = Lock()
+        # Scene sharding over worker processes. worker_inboxes[i] is the unix
+        # datagram socketpair worker i receives migrated clients on.
+        self.worker_id = worker_id
+        self.workers = workers
+        self.worker_inboxes = worker_inboxes
+        # tp_id -> (state, socket, unread so far) of clients migrating in
+        self.migrations_in = {}
+        # Ports and tp_ids are strided so workers never hand out the same one
+        self.udp_port = 30000 + worker_id
         self.listener = None
-        self.client_id_generator = 0
+        self.client_id_generator = worker_id - workers + 1
         self.clients = []
+        # scene_id -> frozenset(Transport). Sets are replaced, never mutated in
+        # place, so fan-out paths can iterate them without holding scene_lock.
+        self.scenes = {}
+        self.scene_lock = Lock()
+        # Area of interest: status and UDP only go to riders within aoi_radius
+        # of the sender's scene_pos, everyone else in the scene gets a status
+        # every aoi_far_interval seconds. 0 radius sends to the whole scene.
+        self.aoi_radius = aoi_radius
+        self.aoi_far_interval = aoi_far_interval
+        # scene_id -> SceneIndex, only kept when aoi_radius is set
+        self.scene_index = {}
+        # Cached Roster, valid while roster_version is unchanged
+        self.roster = None
+        self.roster_version = 0
+        # Clients that negotiated "heartbeat" are dropped after idle_timeout
+        # seconds without a TCP frame, 0 never drops them
+        self.idle_timeout = idle_timeout
+        self.idle_wheel = TimerWheel()
+        # Admission control, 0 is no limit. Counts cover admitted connections,
+        # set up or still queued for setup on setup_loop.
+        self.listen_backlog = listen_backlog
+        self.max_clients = max_clients
+        self.max_clients_per_ip = max_clients_per_ip
+        self.admitted = 0
+        self.conn_per_ip = {}
+        self.admit_lock = Lock()
+        self.setup_loop = None
+        # action (or "udp") -> (rate, burst) per client. Over the limit an
+        # update_status is conflated into the next allowed one, the rest dropped.
+        self.rate_limits = rate_limits or {}
+        # Every received frame and datagram goes to capture, a CaptureWriter
+        self.capture_path = capture_path
+        self.capture = None
 
     def get_client_count(self):
         return len(self.clients)
 
+    def get_scene_clients(self, scene_id):
+        return self.scenes.get(scene_id, ())
+
+    def invalidate_roster(self):
+        self.roster_version += 1
+
+    def get_roster(self):
+        cached = self.roster
+        if cached is not None and cached[0] == self.roster_version:
+            return cached[1]
+        version = self.roster_version
+        roster = Roster(list(self.clients))
+        self.roster = (version, roster)
+        return roster
+
+    def scene_add(self, tp, scene_id):
+        self.invalidate_roster()
+        with self.scene_lock:
+            self.scenes[scene_id] = self.scenes.get(scene_id, frozenset()) | {tp}
+            if self.aoi_radius:
+                self.scene_index.setdefault(scene_id, SceneIndex()).add(tp, tp.aoi_pos)
+
+    def scene_remove(self, tp, scene_id):
+        self.invalidate_roster()
+        with self.scene_lock:
+            members = self.scenes.get(scene_id, frozenset()) - {tp}
+            if members:
+                self.scenes[scene_id] = members
+            else:
+                self.scenes.pop(scene_id, None)
+                for name in self.SCENE_COUNTERS:
+                    METRICS.remove(name, (("scene_id", scene_id),))
+            index = self.scene_index.get(scene_id)
+            if index is not None:
+                index.remove(tp, tp.aoi_pos)
+                if not index:
+                    del self.scene_index[scene_id]
+
+    def scene_move(self, tp, pos):
+        with self.scene_lock:
+            index = self.scene_index.get(tp.client_info["scene_id"])
+            if index is not None:
+                index.move(tp, tp.aoi_pos, pos)
+            tp.aoi_pos = pos
+
+    def get_nearby_clients(self, tp):
+        if not self.aoi_radius:
+            return self.get_scene_clients(tp.client_info["scene_id"])
+        with self.scene_lock:
+            index = self.scene_index.get(tp.client_info["scene_id"])
+            if index is None:
+                return ()
+            return index.query(tp.aoi_pos - self.aoi_radius, tp.aoi_pos + self.aoi_radius)
+
+    def far_update_due(self, tp):
+        # True once every aoi_far_interval, the status then goes to the whole scene
+        now = time.time()
+        if now - tp.far_status_time < self.aoi_far_interval:
+            return False
+        tp.far_status_time = now
+        return True
+
+    def on_scene_change_cb(self, tp, old_scene, new_scene):
+        self.scene_remove(tp, old_scene)
+        tp.aoi_pos = status_pos(tp.client_info)
+        self.scene_add(tp, new_scene)
+
     def get_next_udp_port(self):
-        self.udp_port += 1
+        self.udp_port += self.workers
         if self.udp_port > 40000:
-            self.udp_port = 30001
+            self.udp_port = 30001 + self.worker_id
         return self.udp_port
 
+    #########################################################
+    # Scene sharding
+    #
+    # Each worker owns the scenes whose crc32 maps to it. A client
+    # whose update_status moves it into a scene of another worker
+    # is migrated there: its queued output is written out, then
+    # the TCP socket goes over the owner's inbox (SCM_RIGHTS)
+    # together with the client state, the status that moved it
+    # and any bytes read but not dispatched yet. The new owner
+    # replies create_udp_channel again if the client had UDP, so
+    # it re-points its UDP to the new worker.
+    #########################################################
+    def scene_owner(self, scene_id):
+        return zlib.crc32(scene_id.encode()) % self.workers
+
+    def migrate_client(self, tp, status, owner):
+        log("Client %d moves to scene %s on worker %d, migrate" % (tp.tp_id, status["scene_id"], owner))
+        state = {
+            "tp_id": tp.tp_id,
+            "addr": tp.tcp_addr,
+            "client_info": tp.client_info,
+            "user_version": tp.user_version,
+            "features": sorted(tp.features),
+            "status": status,
+            "udp": tp.udp_conn is not None
+        }
+        # Out of this worker right away, no more fan-out to it
+        tp.closed = True
+        self.clients.remove(tp)
+        self.scene_remove(tp, tp.client_info["scene_id"])
+        self.release(tp.tcp_addr[0])
+        if self.capture is not None:
+            self.capture.put(CAPTURE_CLOSE, tp.tp_id)
+        if tp.udp_conn is not None:
+            tp.udp_conn.stop()
+            tp.udp_conn = None
+        tp.tcp_conn.detach(lambda sock, unread: self.send_migration(owner, state, sock, unread))
+
+    def send_migration(self, owner, state, sock, unread):
+        # Socket and state go in one datagram with the first MIGRATION_CHUNK of
+        # the unread bytes, the rest follows in datagrams tagged with the tp_id.
+        # The inbox only queues a few datagrams, wait a while for the owner to
+        # drain it.
+        state = dict(state, unread=len(unread))
+        state_bytes = json.dumps(state).encode()
+        msg = len(state_bytes).to_bytes(4, byteorder="little") + state_bytes + unread[:self.MIGRATION_CHUNK]
+        tag = state["tp_id"].to_bytes(4, byteorder="little", signed=True)
+        outbox = self.worker_inboxes[owner][1]
+        try:
+            outbox.settimeout(self.MIGRATION_TIMEOUT)
+            socket.send_fds(outbox, [msg], [sock.fileno()])
+            for i in range(self.MIGRATION_CHUNK, len(unread), self.MIGRATION_CHUNK):
+                outbox.send(tag + unread[i:i + self.MIGRATION_CHUNK])
+        except OSError as e:
+            log("Migrate client %d to worker %d failed, disconnect: %s" % (state["tp_id"], owner, str(e)))
+        finally:
+            outbox.setblocking(False)
+        sock.close()
+
+    def on_migration_events(self, mask):
+        inbox = self.worker_inboxes[self.worker_id][0]
+        while True:
+            try:
+                msg, fds, flags, addr = socket.recv_fds(inbox, 2 * TcpConnection.PACKET_LIMIT, 1)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log("Worker inbox recv exception: %s" % str(e))
+                return
+            if not fds:
+                # More unread bytes of a client migrating in
+                tp_id = int.from_bytes(msg[:4], byteorder="little", signed=True)
+                migration = self.migrations_in.get(tp_id)
+                if migration is not None:
+                    migration[2].extend(msg[4:])
+                    if len(migration[2]) >= migration[0]["unread"]:
+                        del self.migrations_in[tp_id]
+                        self.adopt_migration(*migration)
+                continue
+            sock = socket.socket(fileno=fds[0])
+            try:
+                state_len = int.from_bytes(msg[:4], byteorder="little")
+                state = json.loads(msg[4:4 + state_len])
+            except Exception as e:
+                log("Adopt migrated client failed: %s" % str(e))
+                sock.close()
+                continue
+            unread = bytearray(msg[4 + state_len:])
+            if len(unread) < state.get("unread", 0):
+                self.migrations_in[state["tp_id"]] = (state, sock, unread)
+            else:
+                self.adopt_migration(state, sock, unread)
+
+    def adopt_migration(self, state, sock, unread):
+        try:
+            self.adopt_client(state, sock, bytes(unread))
+        except Exception as e:
+            log("Adopt migrated client failed: %s" % str(e))
+            sock.close()
+
+    def adopt_client(self, state, sock, unread):
+        tp = Transport(state["tp_id"], sock, tuple(state["addr"]),
+                       self.on_tcp_recv_callback, self.on_udp_recv_callback, self.on_connection_close_cb,
+                       self.loop, self.on_scene_change_cb,
+                       OutboundQueue(self.send_queue_policy, self.send_queue_frames, self.send_queue_bytes))
+        tp.client_info.update(state["client_info"])
+        tp.user_version = state["user_version"]
+        tp.features = set(state["features"])
+        tp.aoi_pos = status_pos(tp.client_info)
+        log("Client %d migrated in" % tp.tp_id)
+        self.admit(tp.tcp_addr[0], force=True)
+        if self.capture is not None:
+            self.capture.put(CAPTURE_CONNECT, tp.tp_id, tp.tcp_addr[0].encode())
+        self.clients.append(tp)
+        self.scene_add(tp, tp.client_info["scene_id"])
+        tp.start(welcome=False)
+        if "heartbeat" in tp.features:
+            self.watch_idle(tp)
+        self.update_status(tp, state["status"])
+        if state["udp"]:
+            self.create_udp_channel(tp)
+        if unread and not tp.closed:
+            tp.tcp_conn.feed(unread)
+
 #########################################################
 # cmd = {
 #     "action": ACTIONS,
-#     "data": DATA
+#     "data": DATA,
+#     "req_id": optional, echoed in the reply of actions that have one
 # }
 # ACTIONS:
 #     "create_udp_channel"
 #     "update_user"
 #     "update_status"
 #     "list_clients"
+#     "broadcast"
+#     "negotiate"
+#     "stats"
+#     "ping"
 # 
 # DATA:
 #     ui = {
@@ -328,14 +2024,63 @@ class TransportServer(object):
 #         "scene_pos": "0",
 #         "speed": "0"
 #     }
+#     negotiate = {
+#         "features": ["binary", "delta", "batch", "compress", "udp_pack", "heartbeat", "udp_seq"]
+#     }
+#     and the reply data is
+#     {
+#         "features": the accepted ones,
+#         "tp_id": 1,
+#         "idle_timeout": seconds, with "heartbeat". Send "ping" (data "",
+#                         replied with "pong") when idle for a third of it,
+#                         the server drops clients silent for all of it.
+#     }
+#     list_clients = "" for the legacy text roster, or a query, every key optional:
+#     {
+#         "scene_id": "1",
+#         "user_domain": "na",
+#         "cursor": next_cursor of the previous page,
+#         "limit": 200
+#     }
+#     and the reply data is
+#     {
+#         "clients": [{"tp_id", "user_id", "user_name", "user_domain", "scene_id",
+#                      "scene_pos", "speed"}],
+#         "next_cursor": null on the last page
+#     }
+#     or an "error" for a malformed query.
+#
+# A connection over MAX_CLIENTS or MAX_CLIENTS_PER_IP gets
+#     {"action": "rejected", "data": reason}
+# in place of "Welcome!", and is closed right after.
 #########################################################
-    def create_udp_channel(self, tp):
+    def send_reply(self, tp, reply, req_id=None):
+        if req_id is not None:
+            reply["req_id"] = req_id
+        tp.send_tcp_data(json.dumps(reply).encode())
+
+    def create_udp_channel(self, tp, req_id=None):
         if tp.udp_conn is not None:
             log("UDP socket channel created already, Ignore this request")
+            if req_id is not None:
+                reply = {
+                    "action": "create_udp_channel",
+                    "data": "",
+                    "error": "UDP channel exists"
+                }
+                self.send_reply(tp, reply, req_id)
+            return
+        if self.udp_channel is not None:
+            tp.udp_conn = self.udp_channel.add_peer(tp)
+            reply = {
+                "action": "create_udp_channel",
+                "data": "%d" % self.udp_channel.port,
+                "token": tp.udp_conn.token
+            }
+            self.send_reply(tp, reply, req_id)
             return
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
-        udp_socket.settimeout(1)
         udp_port = self.get_next_udp_port()
         while True:
             try:
@@ -345,131 +2090,860 @@ class TransportServer(object):
                 log("Bind on port %d failed, try another port" % udp_port)
                 udp_port = self.get_next_udp_port()
                 continue
-        tp.udp_conn = UdpConnection(udp_socket, tp.on_udp_data_recv_callback, tp.on_udp_close_cb)
-        tp.udp_conn.start()
+        tp.start_udp(udp_socket)
         reply = {
             "action": "create_udp_channel",
             "data": "%d" % udp_port
         }
-        tp.send_tcp_data(json.dumps(reply).encode())
+        self.send_reply(tp, reply, req_id)
 
     def update_user(self, tp, ui_str):
         tp.update_user(ui_str)
+        self.invalidate_roster()
 
-    def update_status(self, tp, si_str):
-        # Save in tp itself
-        tp.update_status(si_str)
+    def negotiate(self, tp, ng_str, req_id=None):
+        requested = json.loads(ng_str).get("features", [])
+        tp.features = set(f for f in requested if f in SERVER_FEATURES)
+        accepted = {"features": sorted(tp.features), "tp_id": tp.tp_id}
+        if "heartbeat" in tp.features:
+            # The client pings when it has nothing else to send for a while
+            accepted["idle_timeout"] = self.idle_timeout
+            self.watch_idle(tp)
+        reply = {
+            "action": "negotiate",
+            "data": json.dumps(accepted)
+        }
+        self.send_reply(tp, reply, req_id)
+
+    def ping(self, tp, req_id=None):
+        reply = {
+            "action": "pong",
+            "data": ""
+        }
+        self.send_reply(tp, reply, req_id)
+
+    def watch_idle(self, tp):
+        if self.idle_timeout and not tp.idle_watched:
+            tp.idle_watched = True
+            self.tick_loop.call_soon(self.idle_wheel.add, tp.last_recv + self.idle_timeout, tp)
+
+    def start_idle_tick(self):
+        self.tick_loop.call_later(self.idle_wheel.tick, self.on_idle_tick)
 
+    def on_idle_tick(self):
+        # A client only sits in the wheel once, at its last_recv based deadline.
+        # Frames since then push it back, instead of costing a wheel update each.
+        self.start_idle_tick()
+        now = time.monotonic()
+        for tp in self.idle_wheel.advance(now):
+            if tp.closed:
+                continue
+            deadline = tp.last_recv + self.idle_timeout
+            if deadline > now:
+                self.idle_wheel.add(deadline, tp)
+                continue
+            log("Client %d idle for %.1fs, drop it" % (tp.tp_id, now - tp.last_recv))
+            METRICS.inc("idle_dropped_total")
+            tp.drop()
+
+    def rider_info_message(self, tp):
+        info = {
+            "tp_id": tp.tp_id,
+            "user_id": tp.client_info["user_id"],
+            "user_name": tp.client_info["user_name"],
+            "user_domain": tp.client_info["user_domain"]
+        }
+        msg = {
+            "action": "rider_info",
+            "data": json.dumps(info)
+        }
+        return json.dumps(msg).encode()
+
+    def status_message(self, tp, status):
         #Combine basic user info
-        info = json.loads(si_str)
+        info = dict(status)
         info["user_id"]     = tp.client_info["user_id"]
         info["user_name"]   = tp.client_info["user_name"]
         info["user_domain"] = tp.client_info["user_domain"]
-        info_str = json.dumps(info)
         msg = {
             "action": "rider_status_update",
-            "data": info_str
+            "data": json.dumps(info)
+        }
+        return json.dumps(msg).encode()
+
+    def status_delta_message(self, tp, fields, full):
+        info = {"tp_id": tp.tp_id}
+        if full:
+            info["full"] = True
+            info["user_id"]     = tp.client_info["user_id"]
+            info["user_name"]   = tp.client_info["user_name"]
+            info["user_domain"] = tp.client_info["user_domain"]
+        info.update(fields)
+        msg = {
+            "action": "rider_status_delta",
+            "data": json.dumps(info)
+        }
+        return json.dumps(msg).encode()
+
+    def update_status(self, tp, status, binary_body=None):
+        if self.workers > 1:
+            owner = self.scene_owner(status["scene_id"])
+            if owner != self.worker_id:
+                self.migrate_client(tp, status, owner)
+                return
+        # Save in tp itself
+        tp.update_status(status)
+        if self.aoi_radius:
+            self.scene_move(tp, status_pos(status))
+        if self.status_tick_hz:
+            # Sent on the next tick, only the latest status of each rider is kept
+            with self.pending_lock:
+                self.pending_status.setdefault(tp.client_info["scene_id"], {})[tp] = status
+            return
+        if self.aoi_radius and not self.far_update_due(tp):
+            clients = self.get_nearby_clients(tp)
+        else:
+            clients = self.get_scene_clients(tp.client_info["scene_id"])
+        self.publish_status(tp, status, clients, binary_body)
+
+    def allow(self, tp, action):
+        limit = self.rate_limits.get(action)
+        if limit is None:
+            return True
+        bucket = tp.buckets.get(action)
+        if bucket is None:
+            bucket = tp.buckets[action] = TokenBucket(*limit)
+        return bucket.take(time.monotonic())
+
+    def on_update_status(self, tp, status, binary_body=None):
+        scene_id = status_scene_id(status)
+        if scene_id is None:
+            log("Bad scene_id in status from %d, discard." % tp.tp_id)
+            return
+        status["scene_id"] = scene_id
+        with tp.status_lock:
+            if self.allow(tp, "update_status"):
+                # Anything deferred is older than this one
+                tp.deferred_status = None
+                self.update_status(tp, status, binary_body)
+                return
+            first = tp.deferred_status is None
+            tp.deferred_status = (status, binary_body and bytes(binary_body))
+            delay = tp.buckets["update_status"].wait_time()
+        METRICS.inc("throttled_total", (("action", "update_status"), ("outcome", "conflated")))
+        if first:
+            self.tick_loop.call_soon(self.tick_loop.call_later, delay, self.send_deferred_status, tp)
+
+    def send_deferred_status(self, tp):
+        # Tick loop, the newest status throttled since the last one went out
+        with tp.status_lock:
+            deferred = tp.deferred_status
+            tp.deferred_status = None
+            if deferred is None or tp.closed:
+                return
+            tp.buckets["update_status"].take(time.monotonic())
+            self.update_status(tp, deferred[0], deferred[1])
+
+    def publish_status(self, tp, status, clients, binary_body=None):
+        delta = dict((k, v) for k, v in status.items() if tp.last_status.get(k) != v)
+        tp.last_status = status
+        tp.status_seq += 1
+        baseline = (tp.status_seq - 1, tp.user_version)
+
+        # Every encoding is framed at most once and the bytes are shared by
+        # all recipients that use it
+        frames = {}
+        if binary_body is None:
+            binary_body = status_to_binary(status)
+        sent = 0
+        for client in clients:
+            if client == tp:
+                continue
+            sent += 1
+            if binary_body is not None and "binary" in client.features:
+                if client.known_riders.get(tp.tp_id) != tp.user_version:
+                    client.known_riders[tp.tp_id] = tp.user_version
+                    client.send_tcp_data(self.rider_info_message(tp))
+                encoding = "binary"
+            elif "delta" in client.features:
+                # Full snapshot unless the client holds the previous status
+                # and no frame for this rider got lost in its send queue
+                lost = client.send_queue.take_lost(tp.tp_id)
+                if client.known_status.get(tp.tp_id) == baseline and not lost:
+                    encoding = "delta"
+                else:
+                    encoding = "full"
+                client.known_status[tp.tp_id] = (tp.status_seq, tp.user_version)
+            else:
+                encoding = "json"
+            frame = frames.get(encoding)
+            if frame is None:
+                if encoding == "binary":
+                    data = BIN_HEADER.pack(BIN_MAGIC, OP_RIDER_STATUS, 0, tp.tp_id) + bytes(binary_body)
+                elif encoding == "delta":
+                    data = self.status_delta_message(tp, delta, False)
+                elif encoding == "full":
+                    data = self.status_delta_message(tp, status, True)
+                else:
+                    data = self.status_message(tp, status)
+                frame = frames[encoding] = TcpConnection.make_frame(data)
+            client.send_tcp_frame(frame, tp.tp_id)
+        self.count_fanout("status", tp.client_info["scene_id"], sent)
+
+    def status_batch_message(self, riders):
+        batch = []
+        for tp, status in riders:
+            info = dict(status)
+            info["tp_id"]       = tp.tp_id
+            info["user_id"]     = tp.client_info["user_id"]
+            info["user_name"]   = tp.client_info["user_name"]
+            info["user_domain"] = tp.client_info["user_domain"]
+            batch.append(info)
+        msg = {
+            "action": "rider_status_batch",
+            "data": json.dumps(batch)
         }
+        return json.dumps(msg).encode()
+
+    def publish_status_batch(self, riders, clients):
+        # One message per recipient for the whole tick, shared by all of them.
+        # Recipients find their own entry in it and skip it.
+        numeric = []
+        others = []
+        for tp, status in riders:
+            body = status_to_binary(status)
+            if body is None:
+                others.append((tp, status))
+            else:
+                numeric.append((tp, body))
+        json_frame = None
+        bin_frame = None
+        rest_frame = None
+        for client in clients:
+            if "binary" in client.features:
+                for tp, body in numeric:
+                    if tp != client and client.known_riders.get(tp.tp_id) != tp.user_version:
+                        client.known_riders[tp.tp_id] = tp.user_version
+                        client.send_tcp_data(self.rider_info_message(tp))
+                if numeric:
+                    if bin_frame is None:
+                        data = [BIN_HEADER.pack(BIN_MAGIC, OP_RIDER_STATUS_BATCH, len(numeric), 0)]
+                        for tp, body in numeric:
+                            data.append(tp.tp_id.to_bytes(4, byteorder="little") + body)
+                        bin_frame = TcpConnection.make_frame(b"".join(data))
+                    client.send_tcp_frame(bin_frame)
+                if others:
+                    if rest_frame is None:
+                        rest_frame = TcpConnection.make_frame(self.status_batch_message(others))
+                    client.send_tcp_frame(rest_frame)
+            else:
+                if json_frame is None:
+                    json_frame = TcpConnection.make_frame(self.status_batch_message(riders))
+                client.send_tcp_frame(json_frame)
+        self.count_fanout("batch", riders[0][0].client_info["scene_id"], len(clients))
 
-        # Broadcast
-        sender_scene = tp.client_info["scene_id"]
-        for client in self.clients:
-            client_scene = client.client_info["scene_id"]
-            if client != tp and client_scene == sender_scene:
-                client.send_tcp_data(json.dumps(msg).encode())
-
-    def list_clients(self, tp):
-        output = ""
-        for client in self.clients:
-            output += "%d, %s\n" % (client.tp_id, json.dumps(client.client_info))
+    def start_status_tick(self):
+        self.tick_loop.call_later(1.0 / self.status_tick_hz, self.on_status_tick)
+
+    def on_status_tick(self):
+        self.start_status_tick()
+        t_start = time.perf_counter()
+        with self.pending_lock:
+            pending = self.pending_status
+            self.pending_status = {}
+        for scene_id, updates in pending.items():
+            riders = [(tp, status) for tp, status in updates.items()
+                      if not tp.closed and tp.client_info["scene_id"] == scene_id]
+            if not riders:
+                continue
+            if self.aoi_radius:
+                self.publish_status_aoi(scene_id, riders)
+                continue
+            batch_clients = []
+            other_clients = []
+            for client in self.get_scene_clients(scene_id):
+                if "batch" in client.features:
+                    batch_clients.append(client)
+                else:
+                    other_clients.append(client)
+            if batch_clients:
+                self.publish_status_batch(riders, batch_clients)
+            if other_clients:
+                for tp, status in riders:
+                    self.publish_status(tp, status, other_clients)
+        METRICS.observe("status_tick_seconds", (), time.perf_counter() - t_start)
+
+    def publish_status_aoi(self, scene_id, riders):
+        # Every recipient gets the riders near itself plus the ones due a far
+        # update. Batch recipients that end up with the same riders share a frame.
+        far = set(tp for tp, status in riders if self.far_update_due(tp))
+        riders.sort(key=lambda r: r[0].aoi_pos)
+        positions = [tp.aoi_pos for tp, status in riders]
+        groups = {}
+        singles = {}
+        for client in self.get_scene_clients(scene_id):
+            i = bisect.bisect_left(positions, client.aoi_pos - self.aoi_radius)
+            j = bisect.bisect_right(positions, client.aoi_pos + self.aoi_radius)
+            seen = riders[i:j]
+            if far:
+                seen = seen + [r for r in riders[:i] + riders[j:] if r[0] in far]
+            if not seen:
+                continue
+            if "batch" in client.features:
+                key = tuple(tp.tp_id for tp, status in seen)
+                groups.setdefault(key, (seen, []))[1].append(client)
+            else:
+                for tp, status in seen:
+                    singles.setdefault(tp, (status, []))[1].append(client)
+        for seen, clients in groups.values():
+            self.publish_status_batch(seen, clients)
+        for tp, (status, clients) in singles.items():
+            self.publish_status(tp, status, clients)
+
+    def list_clients(self, tp, query_str="", req_id=None):
+        if not query_str:
+            # Legacy text roster, one line per client
+            output = "".join("%d, %s\n" % (client.tp_id, json.dumps(client.client_info)) for client in list(self.clients))
+            reply = {
+                "action": "list_clients",
+                "data": output
+            }
+            self.send_reply(tp, reply, req_id)
+            return
+        query = self.parse_roster_query(query_str)
+        if query is None:
+            reply = {
+                "action": "list_clients",
+                "data": "",
+                "error": "bad query"
+            }
+            self.send_reply(tp, reply, req_id)
+            return
+        entries, next_cursor = self.get_roster().page(*query)
+        page = '{"clients": [%s], "next_cursor": %s}' % (",".join(entries), json.dumps(next_cursor))
         reply = {
             "action": "list_clients",
-            "data": output
+            "data": page
         }
-        tp.send_tcp_data(json.dumps(reply).encode())
+        self.send_reply(tp, reply, req_id)
+
+    def parse_roster_query(self, query_str):
+        # (scene_id, user_domain, cursor, limit), None if malformed
+        try:
+            query = json.loads(query_str)
+        except ValueError:
+            return None
+        if not isinstance(query, dict):
+            return None
+        scene_id = query.get("scene_id")
+        user_domain = query.get("user_domain")
+        cursor = query.get("cursor")
+        limit = query.get("limit", self.ROSTER_PAGE)
+        for key in (scene_id, user_domain):
+            if key is not None and not isinstance(key, str):
+                return None
+        if cursor is not None and type(cursor) is not int:
+            return None
+        if type(limit) is not int:
+            return None
+        return scene_id, user_domain, cursor, max(1, min(limit, self.ROSTER_PAGE_MAX))
 
     def broadcast_message(self, tp, data_bytes):
-        sender_pos = tp.client_info["scene_id"]
-        for client in self.clients:
-            client_pos = client.client_info["scene_id"]
-            if client != tp and client_pos == sender_pos:
-                client.send_tcp_data(data_bytes)
+        # Built at most twice, plain and compressed, whatever the scene size
+        frames = {}
+        sent = 0
+        for client in self.get_scene_clients(tp.client_info["scene_id"]):
+            if client != tp:
+                compress = client.wants_compressed(len(data_bytes))
+                frame = frames.get(compress)
+                if frame is None:
+                    frame = frames[compress] = TcpConnection.make_frame(data_bytes, compress)
+                client.send_tcp_frame(frame)
+                sent += 1
+        self.count_fanout("broadcast", tp.client_info["scene_id"], sent)
+
+    def count_fanout(self, kind, scene_id, recipients):
+        METRICS.observe("fanout_size", (("kind", kind),), recipients, Metrics.SIZE_BUCKETS)
+        self.count_scene("scene_fanout_total", scene_id, recipients)
+
+    def count_scene(self, name, scene_id, value=1):
+        # scene_id is any client string, only scenes with members get series
+        # and they go away with the scene, so clients can't grow METRICS
+        if scene_id in self.scenes:
+            METRICS.inc(name, (("scene_id", scene_id),), value)
+
+    def metric_gauges(self):
+        # Sweep scene series counted just as their scene emptied
+        METRICS.prune("scene_id", self.scenes)
+        clients = list(self.clients)
+        depths = [tp.get_send_queue_depth() for tp in clients]
+        gauges = [
+            ("clients", (), len(clients)),
+            ("scenes", (), len(self.scenes)),
+            ("send_queue_depth_total", (), sum(depths)),
+            ("send_queue_depth_max", (), max(depths) if depths else 0),
+            ("send_queue_dropped", (), sum(tp.send_queue.dropped for tp in clients))
+        ]
+        for scene_id, members in list(self.scenes.items()):
+            gauges.append(("scene_clients", (("scene_id", scene_id),), len(members)))
+        if self.workers > 1:
+            gauges = [(name, labels + (("worker", self.worker_id),), v) for name, labels, v in gauges]
+        return gauges
+
+    def stats(self, tp, req_id=None):
+        reply = {
+            "action": "stats",
+            "data": json.dumps(METRICS.snapshot(self.metric_gauges()))
+        }
+        self.send_reply(tp, reply, req_id)
+
+    def dump_metrics(self, path):
+        # Prometheus text format, written aside and renamed so scrapers never see half a file
+        try:
+            with open(path + ".tmp", "w") as f:
+                f.write(METRICS.prometheus_text(self.metric_gauges()))
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            log("Error dumping metrics to %s: %s" % (path, e))
+
+    def on_binary_recv(self, tp, data_bytes):
+        if len(data_bytes) < BIN_HEADER.size:
+            log("Short binary frame from %d, discard." % tp.tp_id)
+            return
+        magic, opcode, flags, sender_id = BIN_HEADER.unpack_from(data_bytes)
+        body = data_bytes[BIN_HEADER.size:]
+        if opcode == OP_UPDATE_STATUS and len(body) >= BIN_STATUS.size:
+            body = body[:BIN_STATUS.size]
+            self.on_update_status(tp, binary_to_status(body), body)
+        else:
+            log("No handling on binary opcode %d, discard." % opcode)
 
     def on_tcp_recv_callback(self, tp, data_bytes):
-        data_str = data_bytes.decode()
-        #log("TCP data from %d: [%s]" % (tp.tp_id, data_str))
+        t_start = time.perf_counter()
+        tp.last_recv = time.monotonic()
+        if self.capture is not None:
+            # data_bytes may be a view into the read buffer, keep a copy
+            self.capture.put(CAPTURE_TCP, tp.tp_id, bytes(data_bytes))
+        scene_id = tp.client_info["scene_id"]
+        if data_bytes and data_bytes[0] == BIN_MAGIC:
+            action = "binary"
+            self.on_binary_recv(tp, data_bytes)
+        else:
+            action = self.on_json_recv(tp, data_bytes)
+        if action not in self.ACTIONS:
+            action = "other"
+        labels = (("action", action),)
+        METRICS.inc("tcp_in_messages_total", labels)
+        METRICS.inc("tcp_in_bytes_total", labels, len(data_bytes) + TcpConnection.HEADER_LEN)
+        self.count_scene("scene_messages_total", scene_id)
+        METRICS.observe("handler_seconds", labels, time.perf_counter() - t_start)
+
+    def on_json_recv(self, tp, data_bytes):
+        data_str = str(data_bytes, "utf-8")
+        if log_enabled("tcp", 2):
+            log("TCP data from %d: [%s]" % (tp.tp_id, data_str), "tcp", 2)
         cmd = json.loads(data_str)
+        req_id = cmd.get("req_id")
+        if cmd["action"] != "update_status" and not self.allow(tp, cmd["action"]):
+            METRICS.inc("throttled_total", (("action", cmd["action"]), ("outcome", "dropped")))
+            if req_id is not None:
+                reply = {
+                    "action": cmd["action"],
+                    "data": "",
+                    "error": "rate limited"
+                }
+                self.send_reply(tp, reply, req_id)
+            return cmd["action"]
         if cmd["action"] == "create_udp_channel":
-            self.create_udp_channel(tp)
+            self.create_udp_channel(tp, req_id)
         elif cmd["action"] == "update_user":
             self.update_user(tp, cmd["data"])
         elif cmd["action"] == "update_status":
-            self.update_status(tp, cmd["data"])
+            self.on_update_status(tp, json.loads(cmd["data"]))
         elif cmd["action"] == "list_clients":
-            self.list_clients(tp)
+            self.list_clients(tp, cmd["data"], req_id)
         elif cmd["action"] == "broadcast":
             self.broadcast_message(tp, data_bytes)
+        elif cmd["action"] == "negotiate":
+            self.negotiate(tp, cmd["data"], req_id)
+        elif cmd["action"] == "stats":
+            self.stats(tp, req_id)
+        elif cmd["action"] == "ping":
+            self.ping(tp, req_id)
         else:
             log("No handling on the data, discard.")
+        return cmd["action"]
 
     def on_udp_recv_callback(self, tp, data_bytes):
-        #log("Received UDP data %d bytes from %d, dispatch to all other clients" % (len(data_bytes), tp.tp_id))
-        sender_pos = tp.client_info["scene_id"]
-        for client in self.clients:
-            client_pos = client.client_info["scene_id"]
-            if client != tp and client_pos == sender_pos:
-                client.send_udp_data(data_bytes)
-                #log("%d bytes udp data send from %s to %s" % (len(data_bytes), tp.client_info["user_id"], client.client_info["user_id"]))
+        if log_enabled("udp", 2):
+            log("Received UDP data %d bytes from %d, dispatch to all other clients" % (len(data_bytes), tp.tp_id), "udp", 2)
+        t_start = time.perf_counter()
+        if self.capture is not None:
+            self.capture.put(CAPTURE_UDP, tp.tp_id, bytes(data_bytes))
+        METRICS.inc("udp_in_messages_total")
+        METRICS.inc("udp_in_bytes_total", (), len(data_bytes))
+        if not self.allow(tp, "udp"):
+            METRICS.inc("throttled_total", (("action", "udp"), ("outcome", "dropped")))
+            return
+        if "udp_seq" in tp.features and data_bytes.startswith(UDP_SEQ_MAGIC):
+            data_bytes = self.check_udp_seq(tp, data_bytes)
+            if data_bytes is None:
+                return
+        self.count_scene("scene_messages_total", tp.client_info["scene_id"])
+        self.relay_udp(tp, self.get_nearby_clients(tp), data_bytes)
+        METRICS.observe("relay_seconds", (("proto", "udp"),), time.perf_counter() - t_start)
 
+    def check_udp_seq(self, tp, data_bytes):
+        # The datagram to relay, None if it is stale or malformed. The
+        # sender id is always the sender's own tp_id, whatever it claimed.
+        if len(data_bytes) < UDP_SEQ_HEADER.size:
+            METRICS.inc("udp_seq_dropped_total", (("reason", "malformed"),))
+            return None
+        magic, sender_id, seq, send_ms = UDP_SEQ_HEADER.unpack_from(data_bytes)
+        if tp.udp_seq is not None and not seq_newer(seq, tp.udp_seq):
+            METRICS.inc("udp_seq_dropped_total", (("reason", "stale"),))
+            if log_enabled("udp", 2):
+                log("Drop stale UDP seq %d from %d, last relayed %d" % (seq, tp.tp_id, tp.udp_seq), "udp", 2)
+            return None
+        if tp.udp_seq is not None and seq != (tp.udp_seq + 1) & 0xFFFFFFFF:
+            METRICS.inc("udp_seq_gap_total", (), (seq - tp.udp_seq - 1) & 0xFFFFFFFF)
+        tp.udp_seq = seq
+        if sender_id != tp.tp_id:
+            data_bytes = UDP_SEQ_HEADER.pack(UDP_SEQ_MAGIC, tp.tp_id, seq, send_ms) + data_bytes[UDP_SEQ_HEADER.size:]
+        return data_bytes
+
+    def relay_udp(self, tp, clients, data_bytes):
+        # Validate and slice the payload once, then one tight sendto pass.
+        # Each peer gets the datagram as is, without its sequence header
+        # (no "udp_seq") or split into its payloads (packed, no "udp_pack"),
+        # each one behind the sequence header for "udp_seq" peers. Every
+        # variant is built once.
+        if not data_bytes:
+            return
+        if len(data_bytes) > UdpConnection.PACKET_LIMIT:
+            data_bytes = data_bytes[:UdpConnection.PACKET_LIMIT]
+        body = data_bytes
+        sequenced = "udp_seq" in tp.features and data_bytes.startswith(UDP_SEQ_MAGIC)
+        if sequenced:
+            body = data_bytes[UDP_SEQ_HEADER.size:]
+            if not body:
+                return
+        packed = "udp_pack" in tp.features and body.startswith(UDP_PACK_MAGIC)
+        variants = {}
+        sent = 0
+        datagrams = 0
+        out_bytes = 0
+        for client in clients:
+            udp_conn = client.udp_conn
+            if client is tp or udp_conn is None:
+                continue
+            target = udp_conn.target
+            if target is None:
+                continue
+            if packed and "udp_pack" not in client.features:
+                key = "seq_split" if sequenced and "udp_seq" in client.features else "split"
+            elif sequenced and "udp_seq" in client.features:
+                key = "seq"
+            else:
+                key = "body"
+            out = variants.get(key)
+            if out is None:
+                if key == "split":
+                    out = unpack_udp(body) or [body]
+                elif key == "seq_split":
+                    header = bytes(data_bytes[:UDP_SEQ_HEADER.size])
+                    out = [header + part for part in unpack_udp(body) or [body]]
+                elif key == "seq":
+                    out = [data_bytes]
+                else:
+                    out = [body]
+                variants[key] = out
+            try:
+                for datagram in out:
+                    target[0](datagram, target[1])
+                    datagrams += 1
+                    out_bytes += len(datagram)
+                sent += 1
+            except OSError:
+                pass #Buffer full or peer gone, drop like the network would
+        self.count_fanout("udp", tp.client_info["scene_id"], sent)
+        METRICS.inc("udp_out_messages_total", (), datagrams)
+        METRICS.inc("udp_out_bytes_total", (), out_bytes)
+
+
+    def admit(self, ip, force=False):
+        # None if the connection may stay, the reject reason otherwise
+        with self.admit_lock:
+            if not force:
+                if self.max_clients and self.admitted >= self.max_clients:
+                    return "server full"
+                if self.max_clients_per_ip and self.conn_per_ip.get(ip, 0) >= self.max_clients_per_ip:
+                    return "too many connections from %s" % ip
+            self.admitted += 1
+            self.conn_per_ip[ip] = self.conn_per_ip.get(ip, 0) + 1
+        return None
+
+    def release(self, ip):
+        with self.admit_lock:
+            self.admitted -= 1
+            n = self.conn_per_ip.get(ip, 0) - 1
+            if n > 0:
+                self.conn_per_ip[ip] = n
+            else:
+                self.conn_per_ip.pop(ip, None)
+
+    def reject(self, tcp_socket, tcp_addr, reason):
+        # One frame, never waiting on the client, then close
+        log("Reject connection from %s: %s" % (str(tcp_addr), reason))
+        METRICS.inc("connections_rejected_total")
+        reply = {
+            "action": "rejected",
+            "data": reason
+        }
+        try:
+            tcp_socket.setblocking(False)
+            tcp_socket.send(TcpConnection.make_frame(json.dumps(reply).encode()))
+        except OSError:
+            pass
+        tcp_socket.close()
 
     def on_new_connect_cb(self, tcp_socket, tcp_addr):
-        self.client_id_generator += 1
+        # Runs on the listener, only admission here. The Transport is built
+        # later on setup_loop so accepting keeps up with a reconnect storm.
+        reason = self.admit(tcp_addr[0])
+        if reason is not None:
+            self.reject(tcp_socket, tcp_addr, reason)
+            return
+        METRICS.inc("connections_accepted_total")
+        self.setup_loop.call_soon(self.setup_client, tcp_socket, tcp_addr)
+
+    def setup_client(self, tcp_socket, tcp_addr):
+        self.client_id_generator += self.workers
         tp = Transport(self.client_id_generator, tcp_socket, tcp_addr,
-                       self.on_tcp_recv_callback, self.on_udp_recv_callback, self.on_connection_close_cb)
-        tp.start()
+                       self.on_tcp_recv_callback, self.on_udp_recv_callback, self.on_connection_close_cb,
+                       self.loop, self.on_scene_change_cb,
+                       OutboundQueue(self.send_queue_policy, self.send_queue_frames, self.send_queue_bytes),
+                       self.writer)
+        if self.capture is not None:
+            self.capture.put(CAPTURE_CONNECT, tp.tp_id, tcp_addr[0].encode())
         self.clients.append(tp)
+        self.scene_add(tp, tp.client_info["scene_id"])
+        tp.start()
 
     def on_connection_close_cb(self, tp):
         log("Remove client: %d" % tp.tp_id)
-        self.clients.remove(tp)
+        try:
+            self.clients.remove(tp)
+            self.scene_remove(tp, tp.client_info["scene_id"])
+        finally:
+            # Admission slots must come back whatever went wrong above
+            self.release(tp.tcp_addr[0])
+            if self.capture is not None:
+                self.capture.put(CAPTURE_CLOSE, tp.tp_id)
 
     def start_service(self):
-        self.listener = CommServerListener(svr_ip, svr_port, self.on_new_connect_cb)
-        self.listener.start()
+        if self.capture_path:
+            self.capture = CaptureWriter(self.capture_path)
+            self.capture.start()
+        if self.serving_mode == "loop":
+            self.loop = EventLoop()
+            self.tick_loop = self.loop
+            self.setup_loop = self.loop
+        else:
+            self.writer = EventLoop()
+            self.writer.start()
+            self.tick_loop = self.writer
+            self.setup_loop = EventLoop()
+            self.setup_loop.start()
+        if self.status_tick_hz:
+            self.tick_loop.call_soon(self.start_status_tick)
+        if self.idle_timeout:
+            self.tick_loop.call_soon(self.start_idle_tick)
+        if self.udp_mode == "shared":
+            self.udp_channel = SharedUdpChannel(self.udp_shared_port + self.worker_id, self.loop)
+            self.udp_channel.start()
+        if self.workers > 1:
+            inbox = self.worker_inboxes[self.worker_id][0]
+            inbox.setblocking(False)
+            for pair in self.worker_inboxes:
+                pair[1].setblocking(False)
+            self.loop.register(inbox, selectors.EVENT_READ, self.on_migration_events)
+        if self.loop is not None:
+            self.listener = LoopServerListener(self.loop, self.svr_ip, self.svr_port, self.on_new_connect_cb,
+                                               self.workers > 1, self.listen_backlog)
+            self.listener.start()
+            self.loop.start()
+        else:
+            self.listener = CommServerListener(self.svr_ip, self.svr_port, self.on_new_connect_cb, self.listen_backlog)
+            self.listener.start()
 
-    def stop_service(self):
+    def stop_all(self):
         log("Stop listening.")
         self.listener.stop()
+        if self.setup_loop is not self.loop:
+            # Connections still queued for setup get built before it halts
+            self.setup_loop.stop()
+            self.setup_loop.join()
         log("Stop service, ask all clients to stop.")
-        for tp in self.clients:
+        for tp in list(self.clients):
             tp.stop()
+        if self.udp_channel is not None:
+            self.udp_channel.stop()
+
+    def stop_service(self):
+        if self.loop is None:
+            self.stop_all()
+            self.writer.stop()
+            self.writer.join()
+        else:
+            self.loop.call_soon(self.stop_all)
+            self.loop.stop()
+            self.loop.join()
+        if self.capture is not None:
+            self.capture.stop()
+            self.capture = None
 
 
 # This enables communication server to listen on port LISTEN_PORT for incoming connections
 LISTEN_IP   = ""
 LISTEN_PORT = 2021
 LOG_PATH = "/var/log/atto-comm/atto-comm.log"
+# Rotate at LOG_MAX_BYTES and/or every LOG_ROTATE_SECONDS (0 disables), keep LOG_BACKUP_COUNT files
+LOG_MAX_BYTES = 100 * 1024 * 1024
+LOG_ROTATE_SECONDS = 0
+LOG_BACKUP_COUNT = 5
+# Per-category verbosity, reloaded from LOG_VERBOSITY_PATH on SIGHUP
+LOG_VERBOSITY = {"general": 1, "tcp": 1, "udp": 1}
+LOG_VERBOSITY_PATH = "log_verbosity.json"
+LOG_WRITER = None
+# "thread": two threads per client, "loop": every socket on one event loop thread
+SERVING_MODE = "thread"
+# "per_client": one UDP port per client, "shared": every client on UDP_SHARED_PORT
+UDP_MODE = "per_client"
+UDP_SHARED_PORT = 30000
+# Per-client send queue, overflow policy is "drop_oldest", "latest_status" or "disconnect"
+SEND_QUEUE_POLICY = "latest_status"
+SEND_QUEUE_FRAMES = 1024
+SEND_QUEUE_BYTES = 4 * 1024 * 1024
+# Send rider status aggregated per scene at this rate, 0 sends every update right away
+STATUS_TICK_HZ = 0
+# Status and UDP only to riders within AOI_RADIUS of scene_pos (0 disables), the
+# rest of the scene gets a status every AOI_FAR_INTERVAL seconds
+AOI_RADIUS = 0
+AOI_FAR_INTERVAL = 1.0
+# Worker processes, each owning a share of the scenes (needs SERVING_MODE "loop")
+WORKERS = 1
+WORKER_PIDS = []
+# Prometheus text dump of the metrics, on SIGUSR1 and every METRICS_DUMP_SECONDS (0 disables)
+METRICS_PATH = "/var/log/atto-comm/metrics.prom"
+METRICS_DUMP_SECONDS = 0
+metrics_dump_requested = False
+# Seconds without a TCP frame after which "heartbeat" clients are dropped (0 never)
+IDLE_TIMEOUT = 30
+# Pending connection queue, sized for the whole fleet reconnecting after a restart
+LISTEN_BACKLOG = 1024
+# Connections past these limits get a "rejected" reply and are closed (0 disables).
+# Riders behind carrier NAT share addresses, keep the per IP limit generous.
+MAX_CLIENTS = 0
+MAX_CLIENTS_PER_IP = 0
+# Per client (rate/s, burst) by TCP action, "udp" for datagrams, the ones that
+# fan out to a scene. Actions not listed are unlimited. Throttled update_status
+# is conflated into the next one let through, the rest dropped. Empty
+# disables rate limiting, e.g.
+#     {"update_status": (50, 100), "broadcast": (10, 20), "udp": (200, 400)}
+RATE_LIMITS = {}
+# Record all received traffic here for client_python/replay.py ("" disables)
+CAPTURE_PATH = ""
 
 # Define the signal handler
 def signal_handler(sig, frame):
     global service_running
     service_running = False
 
-if __name__ == "__main__":
-    svr_ip   = LISTEN_IP
-    svr_port = LISTEN_PORT
-    service_running = True
+def reload_signal_handler(sig, frame):
+    load_log_verbosity(LOG_VERBOSITY_PATH)
+    for pid in WORKER_PIDS:
+        os.kill(pid, signal.SIGHUP)
 
-    # Register the signal handler for SIGTERM
-    signal.signal(signal.SIGTERM, signal_handler)
-    signal.signal(signal.SIGINT, signal_handler)
-    may_clean_log(LOG_PATH)
-    log("Start atto-comm service")
-    comm_svr = TransportServer(svr_ip, svr_port)
+def metrics_signal_handler(sig, frame):
+    global metrics_dump_requested
+    metrics_dump_requested = True
+    for pid in WORKER_PIDS:
+        os.kill(pid, signal.SIGUSR1)
+
+def worker_path(path, worker_id, workers):
+    if workers == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return "%s-w%d%s" % (root, worker_id, ext)
+
+def run_service(worker_id=0, workers=1, worker_inboxes=None):
+    global LOG_WRITER, metrics_dump_requested
+    log_path = worker_path(LOG_PATH, worker_id, workers)
+    metrics_path = worker_path(METRICS_PATH, worker_id, workers)
+    capture_path = worker_path(CAPTURE_PATH, worker_id, workers) if CAPTURE_PATH else None
+    LOG_WRITER = LogWriter(log_path, LOG_MAX_BYTES, LOG_ROTATE_SECONDS, LOG_BACKUP_COUNT)
+    LOG_WRITER.start()
+    if os.path.exists(LOG_VERBOSITY_PATH):
+        load_log_verbosity(LOG_VERBOSITY_PATH)
+    log("Start atto-comm service (worker %d/%d)" % (worker_id + 1, workers))
+    comm_svr = TransportServer(LISTEN_IP, LISTEN_PORT, SERVING_MODE, UDP_MODE, UDP_SHARED_PORT,
+                               SEND_QUEUE_POLICY, SEND_QUEUE_FRAMES, SEND_QUEUE_BYTES, STATUS_TICK_HZ,
+                               AOI_RADIUS, AOI_FAR_INTERVAL, worker_id, workers, worker_inboxes, IDLE_TIMEOUT,
+                               LISTEN_BACKLOG, MAX_CLIENTS, MAX_CLIENTS_PER_IP, RATE_LIMITS, capture_path)
     comm_svr.start_service()
 
+    last_dump = time.time()
     while service_running:
         time.sleep(1)
+        if METRICS_DUMP_SECONDS and time.time() - last_dump >= METRICS_DUMP_SECONDS:
+            metrics_dump_requested = True
+        if metrics_dump_requested:
+            metrics_dump_requested = False
+            last_dump = time.time()
+            comm_svr.dump_metrics(metrics_path)
 
     comm_svr.stop_service()
+    LOG_WRITER.stop()
+    LOG_WRITER = None
+
+def run_workers(workers):
+    # Fork the workers, each one a whole server on LISTEN_PORT (SO_REUSEPORT)
+    # owning its share of the scenes, then wait for the stop signal
+    global WORKER_PIDS
+    inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for i in range(workers)]
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            WORKER_PIDS = []
+            run_service(worker_id, workers, inboxes)
+            os._exit(0)
+        WORKER_PIDS.append(pid)
+    log("Started %d workers: %s" % (workers, str(WORKER_PIDS)))
+
+    while service_running:
+        time.sleep(1)
+        for pid in list(WORKER_PIDS):
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                log("Worker %d exited unexpectedly" % pid)
+                WORKER_PIDS.remove(pid)
+
+    for pid in WORKER_PIDS:
+        os.kill(pid, signal.SIGTERM)
+    for pid in WORKER_PIDS:
+        os.waitpid(pid, 0)
+    WORKER_PIDS = []
+
+if __name__ == "__main__":
+    service_running = True
+
+    # Register the signal handler for SIGTERM
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGHUP, reload_signal_handler)
+    signal.signal(signal.SIGUSR1, metrics_signal_handler)
+    if WORKERS > 1:
+        run_workers(WORKERS)
+    else:
+        run_service()
     sys.exit(0)
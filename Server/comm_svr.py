@@ -1,27 +1,209 @@
 #!/usr/bin/env python3
 
+import os
+import queue
+import signal
 import socket
+import struct
 import sys
 import time
 from datetime import datetime
-from threading import Thread
+from threading import Lock, Thread, current_thread
 import json
 
-def log(msg):
+class LogWriter(Thread):
+    # Background log writer. log() only queues records, this thread formats
+    # and writes them in batches and rotates the file by size and/or age,
+    # keeping backup_count old files (path.1 is the newest).
+    BATCH = 512
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, rotate_seconds=0, backup_count=5, echo=False):
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.echo = echo
+        self.records = queue.SimpleQueue()
+        self.file = None
+        self.opened_at = 0
+
+    def put(self, t, msg):
+        self.records.put((t, msg))
+
+    def open_file(self):
+        try:
+            self.file = open(self.path, 'a+')
+        except IOError as e:
+            print("Error opening log file %s: %s" % (self.path, e))
+            self.file = None
+        self.opened_at = time.time()
+
+    def should_rotate(self):
+        if self.file is None:
+            return False
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            return True
+        return self.rotate_seconds and time.time() - self.opened_at >= self.rotate_seconds
+
+    def rotate(self):
+        self.file.close()
+        try:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = "%s.%d" % (self.path, i)
+                if os.path.exists(src):
+                    os.replace(src, "%s.%d" % (self.path, i + 1))
+            if self.backup_count > 0:
+                os.replace(self.path, self.path + ".1")
+            else:
+                os.remove(self.path)
+        except OSError as e:
+            print("Error rotating log file %s: %s" % (self.path, e))
+        self.open_file()
+
+    def next_timeout(self):
+        if not self.rotate_seconds:
+            return None
+        return max(0.0, self.opened_at + self.rotate_seconds - time.time())
+
+    def run(self):
+        self.open_file()
+        if self.should_rotate():
+            self.rotate()
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self.records.get(timeout=self.next_timeout())]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+            if batch:
+                lines = "".join(["%s %s\n" % (str(datetime.fromtimestamp(t)), msg) for t, msg in batch])
+                if self.echo:
+                    print(lines, end="")
+                if self.file is not None:
+                    try:
+                        self.file.write(lines)
+                        self.file.flush()
+                    except IOError:
+                        pass
+            if self.should_rotate():
+                self.rotate()
+        if self.file is not None:
+            self.file.close()
+
+    def stop(self):
+        self.records.put(None)
+        self.join()
+
+def load_log_verbosity(file_path):
+    # {"category": level}, 0 silences a category
+    try:
+        with open(file_path) as f:
+            LOG_VERBOSITY.update(json.load(f))
+    except (IOError, ValueError) as e:
+        log("Error loading log verbosity from %s: %s" % (file_path, e))
+        return
+    log("Log verbosity: %s" % json.dumps(LOG_VERBOSITY))
+
+def log(msg, category="general", level=1):
+    if LOG_VERBOSITY.get(category, 1) < level:
+        return
     # Remove these two lines for debugging
     if len(msg) > 1024:
         msg = msg[:1016] + "[......]"
 
+    if LOG_WRITER is not None:
+        LOG_WRITER.put(time.time(), msg)
+        return
     t_now = datetime.now()
     fmt_msg = "%s %s\n" % (str(t_now), msg)
     print(fmt_msg)
     try:
-        f = open('comm_server.log', 'a+')
+        f = open(LOG_PATH, 'a+')
         f.write(fmt_msg)
         f.close()
     except IOError:
         pass
 
+class FrameError(Exception):
+    pass
+
+def wake_socket(sock):
+    # Unblocks a thread sitting in recv()/accept() on sock, it sees EOF or an
+    # error right away. Lets blocking I/O threads stop without polling.
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass #Unconnected UDP still wakes up on Linux, or closed already
+
+def set_send_timeout(sock, seconds):
+    # Bounds blocking send() only, recv() keeps blocking until data or wake_socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack("ll", int(seconds), int(seconds % 1 * 1000000)))
+
+class FrameDecoder(object):
+    # Reads length prefixed frames with recv_into() into one reusable
+    # bytearray and hands them out as memoryviews, several per read when
+    # they arrived together. A frame view is only valid until the consumer
+    # returns, use bytes(frame) to keep it.
+    def __init__(self, header_len, packet_limit, buf_size=64 * 1024):
+        self.header_len = header_len
+        self.packet_limit = packet_limit
+        self.buf = bytearray(buf_size)
+        self.start = 0
+        self.end = 0
+        self.wanted = header_len
+
+    def recv_from(self, sock):
+        if self.start + self.wanted > len(self.buf) or self.end == len(self.buf):
+            self.make_room()
+        with memoryview(self.buf)[self.end:] as view:
+            n = sock.recv_into(view)
+        self.end += n
+        return n
+
+    def make_room(self):
+        n = self.end - self.start
+        size = max(len(self.buf), self.wanted)
+        if size - n < 4096:
+            size = min(size * 2, self.header_len + self.packet_limit)
+        if size != len(self.buf):
+            buf = bytearray(size)
+            buf[:n] = self.buf[self.start:self.end]
+            self.buf = buf
+        else:
+            self.buf[:n] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = n
+
+    def frames(self):
+        with memoryview(self.buf) as view:
+            while self.end - self.start >= self.header_len:
+                header_end = self.start + self.header_len
+                lens = int.from_bytes(view[self.start:header_end], byteorder="little")
+                if lens > self.packet_limit:
+                    raise FrameError("Frame length %d over limit" % lens)
+                if header_end + lens > self.end:
+                    self.wanted = self.header_len + lens
+                    break
+                frame = view[header_end:header_end + lens]
+                self.start = header_end + lens
+                self.wanted = self.header_len
+                try:
+                    yield frame
+                finally:
+                    frame.release()
+        if self.start == self.end:
+            self.start = self.end = 0
+
 class TcpConnection(Thread):
     PACKET_LIMIT = 1024 * 1024
     HEADER_LEN = 4
@@ -31,8 +213,10 @@ class TcpConnection(Thread):
         self.recv_cb = recv_cb
         self.close_cb = close_cb
         self.socket = socket
-        self.socket.settimeout(1)
+        # Sending to a stalled client still gives up after a second
+        set_send_timeout(self.socket, 1)
         self.client_addr = client_addr
+        self.decoder = FrameDecoder(self.HEADER_LEN, self.PACKET_LIMIT)
         self.running = False
 
     def send_data(self, data_bytes):
@@ -44,40 +228,28 @@ class TcpConnection(Thread):
         header = data_len.to_bytes(self.HEADER_LEN, byteorder="little")
         self.socket.send(header + data_bytes)
 
-    def recv_data(self):
-        data = bytes([])
-        header = self.socket.recv(self.HEADER_LEN)
-        if not header:
-            return b""
-        lens = int.from_bytes(header, byteorder="little")
-        # Receiving data block
-        n_received = 0
-        while n_received < lens:
-            remaining = lens - n_received
-            buf_len = min(remaining, 4096)
-            data += self.socket.recv(buf_len)
-            n_received = len(data)
-        return data
-
     def run(self):
         self.send_data(b'{"action": "Welcome!", "data":""}') #Debugging purpose
         self.running = True
         while self.running:
             try:
-                data_buf = self.recv_data()
-                if not data_buf:
-                    log("Connnection closed by peer, quit this connection.")
+                if not self.decoder.recv_from(self.socket):
+                    if self.running:
+                        log("Connnection closed by peer, quit this connection.")
                     break
-            except socket.timeout:
-                continue
             except Exception as e:
-                log("Socket recv exception: %s" % str(e))
+                if self.running:
+                    log("Socket recv exception: %s" % str(e))
+                break
+            try:
+                for data_buf in self.decoder.frames():
+                    if self.recv_cb is not None:
+                        self.recv_cb(data_buf)
+                    else:
+                        log("XXX: Discard data due to callback not available")
+            except FrameError as e:
+                log("Bad frame, quit this connection: %s" % str(e))
                 break
-            else:
-                if self.recv_cb is not None:
-                    self.recv_cb(data_buf)
-                else:
-                    log("XXX: Discard data due to callback not available")
 
         log("TcpConnection exit.")
         self.socket.close()
@@ -86,7 +258,9 @@ class TcpConnection(Thread):
 
     def stop(self):
         self.running = False
-        #TODO: wait up to 1 second until thread quit
+        wake_socket(self.socket)
+        if current_thread() is not self and self.is_alive():
+            self.join()
 
 
 class UdpConnection(Thread):
@@ -129,12 +303,12 @@ class UdpConnection(Thread):
             try:
                 data_buf = self.recv_data()
                 if not data_buf:
-                    log("Connnection closed by peer, quit this connection.")
+                    if self.running:
+                        log("Connnection closed by peer, quit this connection.")
                     break
-            except socket.timeout:
-                continue
             except Exception as e:
-                log("Socket recv exception: %s" % str(e))
+                if self.running:
+                    log("Socket recv exception: %s" % str(e))
                 break
             else:
                 if data_buf == b"010011000111":
@@ -152,7 +326,9 @@ class UdpConnection(Thread):
 
     def stop(self):
         self.running = False
-        #TODO: wait up to 1 second until thread quit
+        wake_socket(self.socket)
+        if current_thread() is not self and self.is_alive():
+            self.join()
 
 class Transport(object):
     def __init__(self, tp_id, tp_svr, tcp_socket, tcp_addr, tcp_recv_cb, udp_recv_cb, tp_close_cb):
@@ -166,13 +342,14 @@ class Transport(object):
         self.udp_recv_cb = udp_recv_cb
         self.tp_close_cb = tp_close_cb
         self.closed = False
+        self.stop_lock = Lock()
 
     def start(self):
         self.tcp_conn = TcpConnection(self.tcp_socket, self.tcp_addr, self.on_tcp_data_recv_callback, self.on_tcp_close_cb)
         self.tcp_conn.start()
 
     def on_tcp_data_recv_callback(self, data_bytes):
-        cmd = json.loads(data_bytes.decode())
+        cmd = json.loads(str(data_bytes, "utf-8"))
         if cmd["action"] == "create_udp_channel":
             log("Client request to create UDP channel")
             udp_port = self.creat_udp_channel()
@@ -193,7 +370,6 @@ class Transport(object):
             return
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
-        udp_socket.settimeout(1)
         udp_port = self.tp_svr.get_next_udp_port()
         while True:
             try:
@@ -220,17 +396,17 @@ class Transport(object):
         self.udp_conn.send_data(data)
 
     def on_tcp_close_cb(self):
-        if self.closed:
-            return
         self.stop()
 
     def on_udp_close_cb(self):
-        if self.closed:
-            return
         self.stop()
 
     def stop(self):
-        self.closed = True
+        # TCP and UDP threads may both get here, and each joins the other
+        with self.stop_lock:
+            if self.closed:
+                return
+            self.closed = True
         if self.tcp_conn is not None:
             self.tcp_conn.stop()
             self.tcp_conn = None
@@ -246,6 +422,7 @@ class CommServerListener(Thread):
         self.ip = ip
         self.port = port
         self.new_connect_cb = new_connect_cb
+        self.server_socket = None
         self.running = True
 
     def run(self):
@@ -261,7 +438,6 @@ class CommServerListener(Thread):
             try:
                 server_socket.bind((self.ip, self.port))
                 server_socket.listen(2)
-                server_socket.settimeout(1)
                 log("Listen at : %s:%d" % (self.ip, self.port))
             except Exception as msg:
                 log("Error create socket: %s", msg)
@@ -269,15 +445,19 @@ class CommServerListener(Thread):
                 server_socket = None
                 continue
             break
+        self.server_socket = server_socket
+        if not self.running:
+            wake_socket(server_socket)
 
         # 2. Server socket keep listening and accepting client connections
         while self.running:
             try:
                 client_sock, client_addr = server_socket.accept()
-            except socket.timeout:
-                pass
-            except:
-                raise
+            except OSError as e:
+                if self.running:
+                    log("Accept exception: %s" % str(e))
+                    time.sleep(0.1) #e.g. out of fds, don't spin
+                continue
             else:
                 log("Accept connection from: %s" % '.'.join(map(str, client_addr)))
                 self.new_connect_cb(client_sock, client_addr)
@@ -288,6 +468,9 @@ class CommServerListener(Thread):
     def stop(self):
         log("Stop communication server listener.")
         self.running = False
+        wake_socket(self.server_socket)
+        if current_thread() is not self and self.is_alive():
+            self.join()
 
 class TransportServer(object):
     def __init__(self, svr_ip, svr_port):
@@ -306,8 +489,8 @@ class TransportServer(object):
         return self.udp_port
 
     def on_tcp_recv_callback(self, tp, data_bytes):
-        data_str = data_bytes.decode()
-        log("Tcp data from %d: [%s]" % (tp.tp_id, data_str))
+        data_str = str(data_bytes, "utf-8")
+        log("Tcp data from %d: [%s]" % (tp.tp_id, data_str), "tcp")
         cmd = json.loads(data_str)
         if cmd["action"] == "broadcast":
             log("Client request to broadcast message")
@@ -342,13 +525,21 @@ class TransportServer(object):
         log("Stop listening.")
         self.listener.stop()
         log("Stop service, ask all clients to stop.")
-        for tp in self.clients:
+        for tp in list(self.clients):
             tp.stop()
 
 
 # This enables communication server to listen on port LISTEN_PORT for incoming connections
 LISTEN_IP   = ""
 LISTEN_PORT = 2021
+LOG_PATH = "comm_server.log"
+# Per-category verbosity, reloaded from LOG_VERBOSITY_PATH on SIGHUP
+LOG_VERBOSITY = {"general": 1, "tcp": 1}
+LOG_VERBOSITY_PATH = "log_verbosity.json"
+LOG_WRITER = None
+
+def reload_signal_handler(sig, frame):
+    load_log_verbosity(LOG_VERBOSITY_PATH)
 
 if __name__ == "__main__":
     svr_ip   = LISTEN_IP
@@ -362,6 +553,12 @@ if __name__ == "__main__":
     print("usage: %s [svr_ip(default:all local IPs)] [port(default 2021)]" % sys.argv[0])
     print("")
 
+    LOG_WRITER = LogWriter(LOG_PATH, echo=True)
+    LOG_WRITER.start()
+    if os.path.exists(LOG_VERBOSITY_PATH):
+        load_log_verbosity(LOG_VERBOSITY_PATH)
+    signal.signal(signal.SIGHUP, reload_signal_handler)
+
     log("Start communication service at %s:%d" % (svr_ip, svr_port))
     comm_svr = TransportServer(svr_ip, svr_port)
     comm_svr.start_service()
@@ -376,4 +573,5 @@ if __name__ == "__main__":
             print("Number of clients: %d" % comm_svr.get_client_count())
 
     comm_svr.stop_service()
+    LOG_WRITER.stop()
     sys.exit(0)
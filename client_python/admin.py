@@ -1,8 +1,8 @@
 #!/usr/bin/env python
+from concurrent.futures import TimeoutError
 import json
-from libpyclient import Transport
+from libpyclient import ServerError, Transport, format_stats
 import sys
-import time
 
 def update_user_info(tp):
     ui = {
@@ -42,9 +42,10 @@ if __name__ == "__main__":
     update_status(tp)
 
     # 4. Tell server to create UDP channel
-    tp.create_udp_channel()
-
-    time.sleep(1)
+    try:
+        tp.create_udp_channel().result(5)
+    except TimeoutError:
+        print("No UDP channel reply from server")
     prompt_str = "[atto-admin@%s]#" % svr_ip;
     print("Type 'help' to show valid commands")
     while True:
@@ -55,6 +56,8 @@ if __name__ == "__main__":
         if in_str == "help":
             print("Unsurpported command [%s], ignored. Supported commands:" % in_str)
             print("    list         - List all clients")
+            print("    list <scene> - List clients in a scene")
+            print("    stats        - Show server metrics")
             print("    totcp:<data> - Send tcp data to server for broadcasting")
             print("    toudp:<data> - Send udp data to server")
             print("    <data>       - Send general data to server")
@@ -63,10 +66,22 @@ if __name__ == "__main__":
             print("exit now......")
             tp.close()
             break;
-        elif in_str == "list":
-            print("List of all clients:")
-            tp.list_clients()
-            time.sleep(1)
+        elif in_str == "list" or in_str.startswith("list "):
+            scene_id = in_str[5:].strip() or None
+            print("List of all clients:" if scene_id is None else "List of clients in scene %s:" % scene_id)
+            try:
+                for client in tp.roster(scene_id):
+                    print("%d, %s" % (client["tp_id"], json.dumps(client)))
+            except TimeoutError:
+                print("No reply from server")
+            except ServerError as e:
+                print("Server error: %s" % str(e))
+        elif in_str == "stats":
+            print("Server metrics:")
+            try:
+                print(format_stats(json.loads(tp.call("stats")["data"])))
+            except TimeoutError:
+                print("No reply from server")
         elif in_str.startswith("totcp:"):
             print("Send tcp data to server for broadcasting......")
             tp.broadcast_tcp_message(in_str)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# Rider swarm load generator for atto-comm.
+#
+# Spawns simulated riders spread over a number of scenes. Every rider runs the
+# real handshake (update_user, update_status, create_udp_channel) and then sends
+# update_status and UDP payloads at fixed rates. Both carry the send time, so the
+# receiving riders measure relay latency. Results are appended as one JSON line
+# per run to --output, and --compare prints this run next to the previous one.
+#
+#   python bench.py 127.0.0.1 2021 --riders 500 --scenes 20 --duration 30 --server-pid 1234
+import argparse
+import concurrent.futures
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+import libpyclient
+from libpyclient import Transport
+
+# UDP payload head: bench rider index, sequence number, send time
+UDP_HEAD = struct.Struct("<IId")
+
+class Recorder(object):
+    def __init__(self):
+        self.udp_latency = []
+        self.status_latency = []
+        self.udp_sent = 0
+        self.udp_expected = 0
+        self.udp_bytes_sent = 0
+        self.udp_bytes_recv = 0
+        self.status_sent = 0
+        self.status_expected = 0
+        # Only messages sent after t_start are counted on the receiving side
+        self.t_start = None
+        self.recording = False
+
+    def start(self):
+        self.t_start = time.time()
+        self.recording = True
+
+    def on_udp(self, data_bytes):
+        if not self.recording or len(data_bytes) < UDP_HEAD.size:
+            return
+        idx, seq, t_sent = UDP_HEAD.unpack_from(data_bytes)
+        if t_sent < self.t_start:
+            return
+        self.udp_latency.append(time.time() - t_sent)
+        self.udp_bytes_recv += len(data_bytes)
+
+    def on_status(self, info):
+        if not self.recording or "bench_ts" not in info:
+            return
+        t_sent = float(info["bench_ts"])
+        if t_sent < self.t_start:
+            return
+        self.status_latency.append(time.time() - t_sent)
+
+class Rider(object):
+    def __init__(self, idx, scene_id, args, recorder):
+        self.idx = idx
+        self.scene_id = scene_id
+        self.args = args
+        self.recorder = recorder
+        self.tp = Transport(args.svr_ip, args.svr_port, recorder.on_status, recorder.on_udp)
+        self.udp_ready = None
+        self.seq = 0
+        self.pos = 0.0
+        self.next_status = 0.0
+        self.next_udp = 0.0
+
+    def connect(self):
+        self.tp.connect()
+        if self.args.features:
+            self.tp.negotiate(self.args.features.split(","))
+        ui = {
+            "user_id": "bench%d" % self.idx,
+            "user_name": "bench%d" % self.idx,
+            "user_domain": "bench"
+        }
+        self.tp.client_update_user(json.dumps(ui))
+        self.send_status()
+        self.udp_ready = self.tp.create_udp_channel()
+
+    def send_status(self):
+        self.pos += self.args.speed / max(self.args.status_rate, 1)
+        status = {
+            "scene_id": self.scene_id,
+            "scene_pos": "%.2f" % self.pos,
+            "speed": "%.2f" % self.args.speed,
+            "bench_ts": "%.6f" % time.time()
+        }
+        self.tp.client_update_status(json.dumps(status))
+
+    def send_udp(self):
+        self.seq += 1
+        head = UDP_HEAD.pack(self.idx, self.seq, time.time())
+        payload = head + b"\0" * max(0, self.args.udp_size - len(head))
+        self.tp.send_udp_data(payload)
+        return len(payload)
+
+def sender_loop(riders, args, recorder, scene_sizes, deadline):
+    status_period = 1.0 / args.status_rate if args.status_rate > 0 else None
+    udp_period = 1.0 / args.udp_rate if args.udp_rate > 0 else None
+    now = time.time()
+    for i, r in enumerate(riders):
+        # Spread the first sends so riders don't fire in lockstep
+        offset = float(i) / max(len(riders), 1)
+        r.next_status = now + (status_period or 0) * offset
+        r.next_udp = now + (udp_period or 0) * offset
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        next_due = deadline
+        for r in riders:
+            peers = scene_sizes[r.scene_id] - 1
+            if status_period is not None:
+                if now >= r.next_status:
+                    r.send_status()
+                    r.next_status += status_period
+                    if recorder.recording:
+                        recorder.status_sent += 1
+                        recorder.status_expected += peers
+                next_due = min(next_due, r.next_status)
+            if udp_period is not None:
+                if now >= r.next_udp:
+                    n = r.send_udp()
+                    r.next_udp += udp_period
+                    if recorder.recording:
+                        recorder.udp_sent += 1
+                        recorder.udp_expected += peers
+                        recorder.udp_bytes_sent += n
+                next_due = min(next_due, r.next_udp)
+        delay = next_due - time.time()
+        if delay > 0:
+            time.sleep(min(delay, 0.05))
+
+def read_proc(pid):
+    # (cpu seconds, rss bytes) of the server process, None if unavailable
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+        with open("/proc/%d/status" % pid) as f:
+            rss = 0
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+        return cpu, rss
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.0))
+    return sorted_values[idx]
+
+def latency_summary(values):
+    values = sorted(values)
+    ms = lambda v: None if v is None else round(v * 1000.0, 3)
+    return {
+        "count": len(values),
+        "p50_ms": ms(percentile(values, 50)),
+        "p99_ms": ms(percentile(values, 99)),
+        "p999_ms": ms(percentile(values, 99.9)),
+        "max_ms": ms(values[-1] if values else None)
+    }
+
+def run(args):
+    libpyclient.debugging_on = args.verbose
+    recorder = Recorder()
+    riders = []
+    scene_sizes = {}
+    for i in range(args.riders):
+        scene_id = str(i % args.scenes + 1)
+        scene_sizes[scene_id] = scene_sizes.get(scene_id, 0) + 1
+        riders.append(Rider(i, scene_id, args, recorder))
+
+    print("Connecting %d riders in %d scenes......" % (args.riders, args.scenes))
+    t_start = time.time()
+    for r in riders:
+        r.connect()
+    # Wait for every UDP channel to be created
+    deadline = time.time() + 30
+    for r in riders:
+        try:
+            r.udp_ready.result(max(0, deadline - time.time()))
+        except concurrent.futures.TimeoutError:
+            print("Rider %d got no UDP channel" % r.idx)
+    connect_time = time.time() - t_start
+    print("Connected in %.2fs" % connect_time)
+    # Binary status frames only carry scene_id, scene_pos and speed, bench_ts is lost
+    status_measured = not any("binary" in r.tp.features for r in riders)
+    if not status_measured:
+        print("Status latency not measured, the binary feature drops bench_ts")
+
+    run_start = time.time()
+    deadline = run_start + args.warmup + args.duration
+    n_threads = max(1, min(args.threads, len(riders)))
+    threads = [threading.Thread(target=sender_loop,
+                                args=(riders[i::n_threads], args, recorder, scene_sizes, deadline))
+               for i in range(n_threads)]
+    for t in threads:
+        t.start()
+
+    time.sleep(args.warmup)
+    proc_start = read_proc(args.server_pid) if args.server_pid else None
+    recorder.start()
+    t_measure = recorder.t_start
+    peak_rss = proc_start[1] if proc_start else 0
+    while time.time() < deadline:
+        time.sleep(min(1.0, max(0.0, deadline - time.time())))
+        if args.server_pid:
+            proc = read_proc(args.server_pid)
+            if proc:
+                peak_rss = max(peak_rss, proc[1])
+    for t in threads:
+        t.join()
+    # Let in-flight messages land
+    time.sleep(args.drain)
+    recorder.recording = False
+    elapsed = time.time() - t_measure
+    proc_end = read_proc(args.server_pid) if args.server_pid else None
+
+    for r in riders:
+        r.tp.close()
+
+    udp_recv = len(recorder.udp_latency)
+    status_recv = len(recorder.status_latency)
+    result = {
+        "label": args.label,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            "riders": args.riders,
+            "scenes": args.scenes,
+            "status_rate": args.status_rate,
+            "udp_rate": args.udp_rate,
+            "udp_size": args.udp_size,
+            "duration": args.duration,
+            "features": args.features
+        },
+        "connect_s": round(connect_time, 3),
+        "udp_latency": latency_summary(recorder.udp_latency),
+        "udp_sent_per_s": round(recorder.udp_sent / elapsed, 1),
+        "udp_recv_per_s": round(udp_recv / elapsed, 1),
+        "udp_recv_mbit": round(recorder.udp_bytes_recv * 8 / elapsed / 1e6, 3),
+        "udp_drop_rate": round(1.0 - udp_recv / float(recorder.udp_expected), 5) if recorder.udp_expected else None,
+        "status_sent_per_s": round(recorder.status_sent / elapsed, 1),
+    }
+    if status_measured:
+        result["status_latency"] = latency_summary(recorder.status_latency)
+        result["status_recv_per_s"] = round(status_recv / elapsed, 1)
+        result["status_drop_rate"] = round(1.0 - status_recv / float(recorder.status_expected), 5) if recorder.status_expected else None
+    if proc_start and proc_end:
+        result["server_cpu_pct"] = round((proc_end[0] - proc_start[0]) / elapsed * 100.0, 1)
+        result["server_rss_mb"] = round(proc_end[1] / 1e6, 1)
+        result["server_peak_rss_mb"] = round(peak_rss / 1e6, 1)
+    return result
+
+def load_previous(path):
+    try:
+        with open(path) as f:
+            lines = [line for line in f if line.strip()]
+    except IOError:
+        return None
+    return json.loads(lines[-1]) if lines else None
+
+def flatten(result, prefix=""):
+    out = {}
+    for k, v in result.items():
+        if isinstance(v, dict):
+            out.update(flatten(v, prefix + k + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[prefix + k] = v
+    return out
+
+def print_compare(previous, result):
+    print("%-28s %14s %14s" % ("metric", previous.get("label") or "previous", result.get("label") or "this run"))
+    prev, cur = flatten(previous), flatten(result)
+    for k in sorted(cur):
+        if k.startswith("config."):
+            continue
+        print("%-28s %14s %14s" % (k, prev.get(k, "-"), cur[k]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="atto-comm rider swarm benchmark")
+    parser.add_argument("svr_ip", nargs="?", default="127.0.0.1")
+    parser.add_argument("svr_port", nargs="?", type=int, default=2021)
+    parser.add_argument("--riders", type=int, default=100)
+    parser.add_argument("--scenes", type=int, default=10)
+    parser.add_argument("--status-rate", type=float, default=10.0, help="update_status per rider per second")
+    parser.add_argument("--udp-rate", type=float, default=20.0, help="UDP datagrams per rider per second")
+    parser.add_argument("--udp-size", type=int, default=64)
+    parser.add_argument("--speed", type=float, default=8.0)
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--drain", type=float, default=1.0)
+    parser.add_argument("--threads", type=int, default=4, help="sender threads")
+    parser.add_argument("--features", default="", help="comma separated features to negotiate, e.g. delta,compress (binary leaves status latency out)")
+    parser.add_argument("--server-pid", type=int, default=0, help="sample server CPU and RSS from /proc")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output", default="bench_results.jsonl", help="results are appended here")
+    parser.add_argument("--compare", action="store_true", help="compare with the last run in --output")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    result = run(args)
+    previous = load_previous(args.output) if args.compare else None
+    print(json.dumps(result, indent=2))
+    with open(args.output, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    if previous is not None:
+        print_compare(previous, result)
+    sys.exit(0)
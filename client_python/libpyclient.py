@@ -1,15 +1,437 @@
 #!/usr/bin/env python
+import asyncio
+import concurrent.futures
+from concurrent.futures import Future
 import json
 import socket
-from threading import Thread
+import struct
+from threading import Condition, Event, Lock, Thread, current_thread
 import time
+import zlib
 
 debugging_on = True
 
+# First UDP packet telling the server our UDP address. Servers that hand out a
+# token in the create_udp_channel reply expect UDP_HELLO_PREFIX + token instead.
+UDP_HELLO = b"010011000111"
+UDP_HELLO_PREFIX = b"atto-hello:"
+
+# Packed UDP datagram, see atto-comm.py. Once the server accepted "udp_pack"
+# small payloads are coalesced into one datagram of up to the MTU, sent when
+# full or UDP_FLUSH_SECONDS after its first payload:
+#     UDP_PACK_MAGIC + n * (length(u16) + payload)
+UDP_PACK_MAGIC = b"\xa7P"
+UDP_SUB_HEADER = struct.Struct("<H")
+UDP_FLUSH_SECONDS = 0.005
+
+# Sequenced UDP datagram, see atto-comm.py. Once the server accepted "udp_seq"
+# every datagram we send, packed or not, carries
+#     UDP_SEQ_MAGIC + sender_id(u32) + seq(u32) + send_ms(u32) + body
+# and the ones relayed to us tell loss, reordering and jitter per sender.
+# Without "udp_pack" the payloads of a packed one come one by one, each
+# with the header of the packed datagram.
+UDP_SEQ_MAGIC = b"\xa7S"
+UDP_SEQ_HEADER = struct.Struct("<2sIII")
+SEQ_MASK = 0xFFFFFFFF
+
+# Binary frames, see atto-comm.py. Only used after the server accepted
+# the "binary" feature in its negotiate reply.
+BIN_MAGIC = 0xA7
+BIN_HEADER = struct.Struct("<BBHI")
+BIN_STATUS = struct.Struct("<idf")
+F32 = struct.Struct("<f")
+OP_UPDATE_STATUS = 1
+OP_RIDER_STATUS = 2
+OP_RIDER_STATUS_BATCH = 3
+BIN_BATCH_ENTRY = struct.Struct("<Iidf")
+
+# Compressed frames, see atto-comm.py. Only sent after the server accepted
+# the "compress" feature, but always understood when received.
+COMPRESSED_FLAG = 0x80000000
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+
 def dbg_log(msg):
     if debugging_on:
         print(msg)
 
+def histogram_quantile(hist, q):
+    # Upper bound of the bucket holding quantile q, None past the last bound
+    target = q * hist["count"]
+    seen = 0
+    for bound, n in zip(hist["bounds"] + [None], hist["buckets"]):
+        seen += n
+        if seen >= target:
+            return bound
+    return None
+
+def format_stats(snap):
+    lines = []
+    for name in sorted(snap["gauges"]):
+        lines.append("%-60s %s" % (name, snap["gauges"][name]))
+    for name in sorted(snap["counters"]):
+        lines.append("%-60s %s" % (name, snap["counters"][name]))
+    for name in sorted(snap["histograms"]):
+        hist = snap["histograms"][name]
+        if not hist["count"]:
+            continue
+        lines.append("%-60s count=%d avg=%.6g p50<=%s p99<=%s" % (
+            name, hist["count"], hist["sum"] / hist["count"],
+            histogram_quantile(hist, 0.5), histogram_quantile(hist, 0.99)))
+    return "\n".join(lines)
+
+class ServerError(Exception):
+    # The server answered a request with an "error" (bad query, rate limited)
+    pass
+
+class FrameError(Exception):
+    pass
+
+def wake_socket(sock):
+    # Unblocks the thread sitting in recv() on sock, it sees EOF right away
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass #Closed already
+
+def make_frame(data_bytes, packet_limit, header_len, compress=False):
+    data_len = len(data_bytes)
+    assert data_len != 0, "Try to send empty string shouldn't happen."
+    if data_len > packet_limit:
+        data_len = packet_limit
+        data_bytes = data_bytes[:data_len]
+    if compress:
+        deflated = zlib.compress(data_bytes, COMPRESS_LEVEL)
+        if len(deflated) < data_len:
+            return (len(deflated) | COMPRESSED_FLAG).to_bytes(header_len, byteorder="little") + deflated
+    return data_len.to_bytes(header_len, byteorder="little") + data_bytes
+
+def inflate(frame, limit):
+    d = zlib.decompressobj()
+    try:
+        data = d.decompress(frame, limit)
+    except zlib.error as e:
+        raise FrameError("Bad compressed frame: %s" % str(e))
+    if d.unconsumed_tail:
+        raise FrameError("Inflated frame over limit %d" % limit)
+    return data
+
+def f32_str(value):
+    # Shortest decimal that reads back as the same float32
+    value = F32.unpack(F32.pack(value))[0]
+    for digits in range(1, 10):
+        text = "%.*g" % (digits, value)
+        if F32.unpack(F32.pack(float(text)))[0] == value:
+            return text
+    return repr(value)
+
+def encode_binary_status(status_str):
+    # OP_UPDATE_STATUS frame of a status, None if it wouldn't read back the
+    # same: scene_id not a plain integer or speed not exact as float32
+    status = json.loads(status_str)
+    try:
+        scene_id = int(status["scene_id"])
+        speed = float(status["speed"])
+        if str(scene_id) != str(status["scene_id"]) or float(f32_str(speed)) != speed:
+            return None
+        body = BIN_STATUS.pack(scene_id, float(status["scene_pos"]), speed)
+    except (KeyError, ValueError, TypeError, OverflowError, struct.error):
+        return None
+    return BIN_HEADER.pack(BIN_MAGIC, OP_UPDATE_STATUS, 0, 0) + body
+
+def decode_binary_status(data_bytes, riders, own_tp_id=None):
+    # Rider status dicts of a binary frame, user info taken from riders
+    # (tp_id -> rider_info). Our own entry in a tick batch is skipped.
+    magic, opcode, flags, sender_id = BIN_HEADER.unpack_from(data_bytes)
+    if opcode == OP_RIDER_STATUS:
+        entries = [(sender_id,) + BIN_STATUS.unpack_from(data_bytes, BIN_HEADER.size)]
+    elif opcode == OP_RIDER_STATUS_BATCH:
+        # flags is the number of riders in this tick
+        entries = [BIN_BATCH_ENTRY.unpack_from(data_bytes, BIN_HEADER.size + i * BIN_BATCH_ENTRY.size)
+                   for i in range(flags)]
+    else:
+        dbg_log("Binary PDU not handled: opcode %d" % opcode)
+        return []
+    infos = []
+    for tp_id, scene_id, scene_pos, speed in entries:
+        if tp_id == own_tp_id:
+            continue
+        info = dict(riders.get(tp_id, {}))
+        info["tp_id"] = tp_id
+        info["scene_id"] = str(scene_id)
+        info["scene_pos"] = str(scene_pos)
+        info["speed"] = f32_str(speed)
+        infos.append(info)
+    return infos
+
+def unpack_udp(data_bytes):
+    # Payloads of a packed datagram, None if it isn't a well formed one
+    if not data_bytes.startswith(UDP_PACK_MAGIC):
+        return None
+    parts = []
+    pos = len(UDP_PACK_MAGIC)
+    end = len(data_bytes)
+    while pos < end:
+        if pos + UDP_SUB_HEADER.size > end:
+            return None
+        (n,) = UDP_SUB_HEADER.unpack_from(data_bytes, pos)
+        pos += UDP_SUB_HEADER.size
+        if n == 0 or pos + n > end:
+            return None
+        parts.append(data_bytes[pos:pos + n])
+        pos += n
+    return parts or None
+
+class UdpPacker(object):
+    # Coalesces payloads into packed datagrams of up to limit bytes. add()
+    # returns the datagrams that are ready, take() whatever is pending.
+    def __init__(self, limit):
+        self.limit = limit
+        self.parts = []
+        self.size = len(UDP_PACK_MAGIC)
+
+    def pending(self):
+        return len(self.parts)
+
+    def add(self, data_bytes):
+        ready = []
+        sub_len = UDP_SUB_HEADER.size + len(data_bytes)
+        if len(UDP_PACK_MAGIC) + sub_len > self.limit:
+            # Can't be packed, keep the order and send it on its own
+            ready.extend(self.take())
+            ready.append(data_bytes)
+            return ready
+        if self.size + sub_len > self.limit:
+            ready.extend(self.take())
+        self.parts.append(UDP_SUB_HEADER.pack(len(data_bytes)))
+        self.parts.append(data_bytes)
+        self.size += sub_len
+        return ready
+
+    def take(self):
+        if not self.parts:
+            return []
+        if len(self.parts) == 2 and not self.parts[1].startswith(UDP_PACK_MAGIC):
+            # A lone payload goes out as is
+            datagram = self.parts[1]
+        else:
+            datagram = UDP_PACK_MAGIC + b"".join(self.parts)
+        self.parts = []
+        self.size = len(UDP_PACK_MAGIC)
+        return [datagram]
+
+def seq_delta(seq, ref):
+    # How far seq is ahead of ref (negative when behind), 32 bit wrapping
+    delta = (seq - ref) & SEQ_MASK
+    return delta - (SEQ_MASK + 1) if delta >= 0x80000000 else delta
+
+def clock_ms():
+    return int(time.monotonic() * 1000) & SEQ_MASK
+
+class UdpSequencer(object):
+    # Puts the "udp_seq" header in front of our datagrams
+    def __init__(self, sender_id):
+        self.sender_id = sender_id
+        self.seq = 0
+
+    def stamp(self, datagram):
+        self.seq = (self.seq + 1) & SEQ_MASK
+        return UDP_SEQ_HEADER.pack(UDP_SEQ_MAGIC, self.sender_id, self.seq, clock_ms()) + datagram
+
+class UdpSenderStats(object):
+    # One sender's sequenced datagrams as they reached us: loss from the
+    # sequence gaps, late (reordered) arrivals and the RFC 3550
+    # interarrival jitter of the send_ms timestamps. Datagrams the server
+    # dropped as stale count as lost here.
+    def __init__(self, seq, send_ms, recv_ms):
+        self.first = seq
+        self.highest = 0  # Relative to first, doesn't wrap
+        self.received = 1
+        self.reordered = 0
+        self.duplicates = 0
+        self.transit = (recv_ms - send_ms) & SEQ_MASK
+        self.jitter = 0.0
+
+    def update(self, seq, send_ms, recv_ms, parts=False):
+        # parts: the latest seq again is another payload of a split datagram
+        delta = seq_delta(seq, (self.first + self.highest) & SEQ_MASK)
+        if delta == 0:
+            if not parts:
+                self.duplicates += 1
+            return
+        self.received += 1
+        if delta > 0:
+            self.highest += delta
+        else:
+            self.reordered += 1
+        transit = (recv_ms - send_ms) & SEQ_MASK
+        self.jitter += (abs(seq_delta(transit, self.transit)) - self.jitter) / 16.0
+        self.transit = transit
+
+    def snapshot(self):
+        expected = self.highest + 1
+        return {
+            "received": self.received,
+            "expected": expected,
+            "lost": max(0, expected - self.received),
+            "reordered": self.reordered,
+            "duplicates": self.duplicates,
+            "jitter_ms": round(self.jitter, 3)
+        }
+
+class JitterBuffer(object):
+    # Puts each sender's datagrams back in sequence order. In order ones
+    # go straight through, after a gap the following ones are held up to
+    # delay seconds for the missing ones before the gap is given up on.
+    # Whatever arrives behind what was already delivered is dropped.
+    def __init__(self, delay):
+        self.delay = delay
+        self.expected = {}  # sender -> next seq to deliver
+        self.held = {}      # sender -> {seq: (deadline, [body])}
+        self.late = 0
+
+    def push(self, sender, seq, body, now, parts=False):
+        # The bodies ready for delivery, in order. With parts a seq can come
+        # with several bodies, payloads of one split datagram.
+        ready = []
+        expected = self.expected.get(sender, seq)
+        if parts and seq == (expected - 1) & SEQ_MASK:
+            # The rest of the datagram just delivered
+            ready.append(body)
+            return ready
+        if seq_delta(seq, expected) < 0:
+            self.late += 1
+            return ready
+        held = self.held.setdefault(sender, {})
+        if seq not in held:
+            held[seq] = (now + self.delay, [body])
+        elif parts:
+            held[seq][1].append(body)
+        self.expected[sender] = self.release(held, expected, now, ready)
+        return ready
+
+    def expire(self, now):
+        ready = []
+        for sender, held in self.held.items():
+            if held:
+                self.expected[sender] = self.release(held, self.expected[sender], now, ready)
+        return ready
+
+    def release(self, held, expected, now, ready):
+        while held:
+            if expected in held:
+                ready.extend(held.pop(expected)[1])
+                expected = (expected + 1) & SEQ_MASK
+            elif min(deadline for deadline, bodies in held.values()) <= now:
+                # Waited long enough, skip to the oldest one we have
+                expected = min(held, key=lambda seq: seq_delta(seq, expected))
+            else:
+                break
+        return expected
+
+    def next_deadline(self):
+        deadlines = [deadline for held in self.held.values() for deadline, bodies in held.values()]
+        return min(deadlines) if deadlines else None
+
+class UdpReceiver(object):
+    # Turns received datagrams into payloads: takes the "udp_seq" header
+    # off keeping per sender statistics, reorders through the optional
+    # jitter buffer and splits packed datagrams. seq and pack are set once
+    # the server accepted the features. Without pack a seq repeated right
+    # away is the next payload of a datagram the server split for us, not
+    # a duplicate.
+    def __init__(self, jitter_delay=0.0):
+        self.seq = False
+        self.pack = False
+        self.stats = {}
+        self.jitter = JitterBuffer(jitter_delay) if jitter_delay > 0 else None
+
+    def receive(self, data_bytes, now):
+        if not self.seq or len(data_bytes) < UDP_SEQ_HEADER.size or not data_bytes.startswith(UDP_SEQ_MAGIC):
+            return self.payloads([data_bytes])
+        magic, sender, seq, send_ms = UDP_SEQ_HEADER.unpack_from(data_bytes)
+        recv_ms = int(now * 1000) & SEQ_MASK
+        stats = self.stats.get(sender)
+        if stats is None:
+            self.stats[sender] = UdpSenderStats(seq, send_ms, recv_ms)
+        else:
+            stats.update(seq, send_ms, recv_ms, not self.pack)
+        body = data_bytes[UDP_SEQ_HEADER.size:]
+        if self.jitter is None:
+            return self.payloads([body])
+        return self.payloads(self.jitter.push(sender, seq, body, now, not self.pack))
+
+    def expire(self, now):
+        return self.payloads(self.jitter.expire(now))
+
+    def payloads(self, datagrams):
+        out = []
+        for datagram in datagrams:
+            parts = unpack_udp(datagram) if self.pack else None
+            out.extend(parts or [datagram])
+        return out
+
+    def statistics(self):
+        # sender tp_id -> UdpSenderStats.snapshot()
+        return dict((sender, stats.snapshot()) for sender, stats in self.stats.items())
+
+class FrameDecoder(object):
+    # Reads length prefixed frames with recv_into() into one reusable
+    # bytearray and hands them out as memoryviews, several per read when
+    # they arrived together. A frame view is only valid until the consumer
+    # returns, use bytes(frame) to keep it.
+    def __init__(self, header_len, packet_limit, buf_size=64 * 1024):
+        self.header_len = header_len
+        self.packet_limit = packet_limit
+        self.buf = bytearray(buf_size)
+        self.start = 0
+        self.end = 0
+        self.wanted = header_len
+
+    def recv_from(self, sock):
+        if self.start + self.wanted > len(self.buf) or self.end == len(self.buf):
+            self.make_room()
+        with memoryview(self.buf)[self.end:] as view:
+            n = sock.recv_into(view)
+        self.end += n
+        return n
+
+    def make_room(self):
+        n = self.end - self.start
+        size = max(len(self.buf), self.wanted)
+        if size - n < 4096:
+            size = min(size * 2, self.header_len + self.packet_limit)
+        if size != len(self.buf):
+            buf = bytearray(size)
+            buf[:n] = self.buf[self.start:self.end]
+            self.buf = buf
+        else:
+            self.buf[:n] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = n
+
+    def frames(self):
+        with memoryview(self.buf) as view:
+            while self.end - self.start >= self.header_len:
+                header_end = self.start + self.header_len
+                lens = int.from_bytes(view[self.start:header_end], byteorder="little")
+                compressed = lens & COMPRESSED_FLAG
+                lens &= ~COMPRESSED_FLAG
+                if lens > self.packet_limit:
+                    raise FrameError("Frame length %d over limit" % lens)
+                if header_end + lens > self.end:
+                    self.wanted = self.header_len + lens
+                    break
+                frame = view[header_end:header_end + lens]
+                self.start = header_end + lens
+                self.wanted = self.header_len
+                try:
+                    yield inflate(frame, self.packet_limit) if compressed else frame
+                finally:
+                    frame.release()
+        if self.start == self.end:
+            self.start = self.end = 0
+
 class TcpConnection(Thread):
     PACKET_LIMIT = 1024 * 1024
     HEADER_LEN = 4
@@ -20,31 +442,13 @@ class TcpConnection(Thread):
         self.svr_port = svr_port
         self.recv_cb = recv_cb
         self.socket = None
+        self.decoder = FrameDecoder(self.HEADER_LEN, self.PACKET_LIMIT)
         self.running = False
+        self.last_send = time.monotonic()
 
-    def send_data(self, data_bytes):
-        data_len = len(data_bytes)
-        assert data_len != 0, "Try to send empty string shouldn't happen."
-        if data_len > self.PACKET_LIMIT:
-            data_len = self.PACKET_LIMIT
-            data_bytes = data_bytes[:data_len]
-        header = data_len.to_bytes(self.HEADER_LEN, byteorder="little")
-        self.socket.send(header + data_bytes)
-
-    def recv_data(self):
-        data = bytes([])
-        header = self.socket.recv(self.HEADER_LEN)
-        if not header:
-            return b""
-        lens = int.from_bytes(header, byteorder="little")
-        # Receiving data block
-        n_received = 0
-        while n_received < lens:
-            remaining = lens - n_received
-            buf_len = min(remaining, 4096)
-            data += self.socket.recv(buf_len)
-            n_received = len(data)
-        return data
+    def send_data(self, data_bytes, compress=False):
+        self.socket.send(make_frame(data_bytes, self.PACKET_LIMIT, self.HEADER_LEN, compress))
+        self.last_send = time.monotonic()
 
     def is_connected(self):
         return self.running;
@@ -53,26 +457,27 @@ class TcpConnection(Thread):
         dbg_log("Connect to communication server at %s:%d" % (self.svr_ip, self.svr_port))
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.svr_ip, self.svr_port))
-        self.socket.settimeout(1)
 
         self.running = True
         while self.running:
             try:
-                client_pdu = self.recv_data()
-                if not client_pdu:
-                    dbg_log("Connnection closed by peer, quit this connection.")
+                if not self.decoder.recv_from(self.socket):
+                    if self.running:
+                        dbg_log("Connnection closed by peer, quit this connection.")
                     break
-            except socket.timeout:
-                continue
             except socket.error as v:
-                errorcode = v[0]
-                dbg_log("Socket recv exception: %s" % str(errorcode))
+                if self.running:
+                    dbg_log("Socket recv exception: %s" % str(v))
+                break
+            try:
+                for client_pdu in self.decoder.frames():
+                    if self.recv_cb is not None:
+                        self.recv_cb(client_pdu)
+                    else:
+                        dbg_log("XXX: Discard message due to callback not available")
+            except FrameError as e:
+                dbg_log("Bad frame, quit this connection: %s" % str(e))
                 break
-            else:
-                if self.recv_cb is not None:
-                    self.recv_cb(client_pdu)
-                else:
-                    dbg_log("XXX: Discard message due to callback not available")
 
         dbg_log("Client TcpConnection exit.")
         self.socket.close()
@@ -83,26 +488,76 @@ class TcpConnection(Thread):
         
     def stop(self):
         self.running = False
-        #TODO: should wait till self.is_connected() to false. This may take up to 1 second.
+        wake_socket(self.socket)
+        if current_thread() is not self and self.is_alive():
+            self.join()
 
 class UdpConnection(Thread):
-    PACKET_LIMIT = 1024
+    PACKET_LIMIT = 1472
 
-    def __init__(self, svr_ip, svr_port=2021, recv_cb=None):
+    def __init__(self, svr_ip, svr_port=2021, recv_cb=None, token=None, pack=False, seq_sender=None):
         Thread.__init__(self)
         self.svr_ip = svr_ip
         self.svr_port = svr_port
         self.recv_cb = recv_cb
+        self.hello = UDP_HELLO if token is None else UDP_HELLO_PREFIX + token.encode()
         self.socket = None
         self.running = False
+        # "udp_seq" header on every datagram, taking room from the payload
+        self.sequencer = UdpSequencer(seq_sender) if seq_sender is not None else None
+        self.payload_limit = self.PACKET_LIMIT - (UDP_SEQ_HEADER.size if self.sequencer else 0)
+        # Packed sending, flushed by its own thread at the deadline
+        self.packer = UdpPacker(self.payload_limit) if pack else None
+        self.pack_cond = Condition()
+        self.flush_at = None
+
+    def send_datagram(self, datagram):
+        if self.sequencer is not None:
+            datagram = self.sequencer.stamp(datagram)
+        self.socket.send(datagram)
 
     def send_data(self, data_bytes):
         data_len = len(data_bytes)
         assert data_len != 0, "Try to send empty string shouldn't happen."
-        if data_len > self.PACKET_LIMIT:
-            data_len = self.PACKET_LIMIT
+        if data_len > self.payload_limit:
+            data_len = self.payload_limit
             data_bytes = data_bytes[:data_len]
-        self.socket.send(data_bytes)
+        if self.packer is None:
+            if self.sequencer is None:
+                self.socket.send(data_bytes)
+            else:
+                with self.pack_cond:
+                    self.send_datagram(data_bytes)
+            return
+        with self.pack_cond:
+            for datagram in self.packer.add(data_bytes):
+                self.send_datagram(datagram)
+            if not self.packer.pending():
+                self.flush_at = None
+            elif self.flush_at is None:
+                self.flush_at = time.time() + UDP_FLUSH_SECONDS
+                self.pack_cond.notify()
+
+    def flush_loop(self):
+        with self.pack_cond:
+            while self.running:
+                if self.flush_at is None:
+                    self.pack_cond.wait()
+                    continue
+                delay = self.flush_at - time.time()
+                if delay > 0:
+                    self.pack_cond.wait(delay)
+                    continue
+                self.flush()
+
+    def flush(self):
+        # Called with pack_cond held
+        self.flush_at = None
+        for datagram in self.packer.take():
+            try:
+                self.send_datagram(datagram)
+            except (OSError, AttributeError) as e:
+                dbg_log("UDP send exception: %s" % str(e))
 
     def recv_data(self):
         data = self.socket.recv(self.PACKET_LIMIT)
@@ -114,21 +569,21 @@ class UdpConnection(Thread):
         dbg_log("Connect to communication server at %s:%d" % (self.svr_ip, self.svr_port))
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.connect((self.svr_ip, self.svr_port))
-        self.socket.settimeout(1)
-        self.send_data(b"010011000111")
+        self.socket.send(self.hello)
 
         self.running = True
+        if self.packer is not None:
+            Thread(target=self.flush_loop, daemon=True).start()
         while self.running:
             try:
                 client_pdu = self.recv_data()
                 if not client_pdu:
-                    dbg_log("Connnection closed by peer, quit this connection.")
+                    if self.running:
+                        dbg_log("Connnection closed by peer, quit this connection.")
                     break
-            except socket.timeout:
-                continue
             except socket.error as v:
-                errorcode = v[0]
-                dbg_log("Socket recv exception: %s" % str(errorcode))
+                if self.running:
+                    dbg_log("Socket recv exception: %s" % str(v))
                 break
             else:
                 if self.recv_cb is not None:
@@ -137,6 +592,10 @@ class UdpConnection(Thread):
                     dbg_log("Discard message due to no callback available")
 
         dbg_log("Client UdpConnection exit.")
+        if self.packer is not None:
+            with self.pack_cond:
+                self.flush()
+                self.pack_cond.notify()
         self.socket.close()
         self.socket = None
 
@@ -145,30 +604,160 @@ class UdpConnection(Thread):
         
     def stop(self):
         self.running = False
-        #TODO: should wait till self.is_connected() to false. This may take up to 1 second.
+        wake_socket(self.socket)
+        if current_thread() is not self and self.is_alive():
+            self.join()
+
+class PendingRequests(object):
+    # Futures of requests waiting for their reply. The server echoes the
+    # request's req_id, replies without one (older servers) are matched by
+    # action in request order. A reply with an unknown req_id (its request
+    # timed out and was discarded) resolves nothing.
+    def __init__(self):
+        self.lock = Lock()
+        self.next_id = 0
+        self.by_id = {}
+        self.by_action = {}
+
+    def add(self, action, future):
+        with self.lock:
+            self.next_id += 1
+            req_id = self.next_id
+            self.by_id[req_id] = (action, future)
+            self.by_action.setdefault(action, []).append(req_id)
+        return req_id
+
+    def discard(self, req_id):
+        with self.lock:
+            entry = self.by_id.pop(req_id, None)
+            if entry is not None:
+                self.by_action[entry[0]].remove(req_id)
+
+    def pop(self, cmd):
+        # The future waiting for this reply, None if nobody asked for it
+        with self.lock:
+            req_id = cmd.get("req_id")
+            if req_id is None:
+                ids = self.by_action.get(cmd["action"])
+                if not ids:
+                    return None
+                req_id = ids[0]
+            elif req_id not in self.by_id:
+                return None
+            action, future = self.by_id.pop(req_id)
+            self.by_action[action].remove(req_id)
+            return future
+
+    def fail_all(self, exc):
+        with self.lock:
+            entries = list(self.by_id.values())
+            self.by_id = {}
+            self.by_action = {}
+        for action, future in entries:
+            if not future.done():
+                future.set_exception(exc)
 
 class Transport(object):
-    def __init__(self, svr_ip, svr_port):
+    # Requests with a reply (create_udp_channel, negotiate, list_clients,
+    # stats) return a concurrent.futures.Future of the reply dict, use
+    # call() or future.result(timeout) to block on it.
+    # jitter_buffer > 0 holds "udp_seq" payloads up to that many seconds to
+    # hand them to udp_recv_cb in sequence order.
+    def __init__(self, svr_ip, svr_port, rider_status_cb=None, udp_recv_cb=None, jitter_buffer=0.0):
         Thread.__init__(self)
         self.svr_ip = svr_ip
         self.svr_port = svr_port
         self.udp_port = None
         self.tcp_conn = None
         self.udp_conn = None
+        # Called with a rider status dict, whatever encoding it arrived in
+        self.rider_status_cb = rider_status_cb
+        self.udp_recv_cb = udp_recv_cb
+        self.tp_id = None
+        self.features = set()
+        self.riders = {}
+        self.pending = PendingRequests()
+        self.heartbeat_stop = Event()
+        # Received UDP goes through udp_rx, under udp_rx_cond as the jitter
+        # buffer is also released by its own thread
+        self.udp_rx = UdpReceiver(jitter_buffer)
+        self.udp_rx_cond = Condition()
+        self.udp_rx_running = False
+
+    def on_binary_recv(self, data_bytes):
+        for info in decode_binary_status(data_bytes, self.riders, self.tp_id):
+            self.on_rider_status(info)
+
+    def on_rider_status(self, info):
+        if self.rider_status_cb is not None:
+            self.rider_status_cb(info)
+        else:
+            dbg_log("Rider status: %s" % json.dumps(info))
 
     def on_tcp_data_recv_callback(self, data_bytes):
-        cmd = json.loads(data_bytes.decode())
+        if data_bytes and data_bytes[0] == BIN_MAGIC:
+            self.on_binary_recv(data_bytes)
+            return
+        cmd = json.loads(str(data_bytes, "utf-8"))
+        future = self.pending.pop(cmd)
+        # Late replies to requests given up on are neither printed nor logged
+        unsolicited = future is None and "req_id" not in cmd
         if cmd["action"] == "create_udp_channel":
-            assert self.udp_conn is None, "Udp channel had already created."
-            self.udp_port = int(cmd["data"])
-            self.udp_conn = UdpConnection(self.svr_ip, self.udp_port, self.on_udp_data_recv_callback)
-            self.udp_conn.start()
-        elif cmd["action"] == "list_clients":
+            if "error" in cmd:
+                dbg_log("Create UDP channel failed: %s" % cmd["error"])
+            else:
+                if self.udp_conn is not None:
+                    # Moved to another server worker, re-point UDP at it
+                    self.udp_conn.stop()
+                self.udp_port = int(cmd["data"])
+                self.udp_conn = UdpConnection(self.svr_ip, self.udp_port, self.on_udp_data_recv_callback, cmd.get("token"),
+                                              "udp_pack" in self.features,
+                                              self.tp_id if "udp_seq" in self.features else None)
+                self.udp_conn.start()
+        elif cmd["action"] == "rejected":
+            # Server full, it closes the connection right after
+            dbg_log("Connection rejected by server: %s" % cmd["data"])
+            self.pending.fail_all(ConnectionRefusedError(cmd["data"]))
+        elif cmd["action"] == "list_clients" and unsolicited:
             print(cmd["data"])
-        else:
-            dbg_log("PDU not handled: [%s]" % data_bytes.decode())
+        elif cmd["action"] == "stats" and unsolicited:
+            print(format_stats(json.loads(cmd["data"])))
+        elif cmd["action"] == "negotiate":
+            reply = json.loads(cmd["data"])
+            self.tp_id = reply["tp_id"]
+            self.features = set(reply["features"])
+            self.udp_rx.seq = "udp_seq" in self.features
+            self.udp_rx.pack = "udp_pack" in self.features
+            if "heartbeat" in self.features and reply.get("idle_timeout"):
+                Thread(target=self.heartbeat_loop, args=(reply["idle_timeout"] / 3.0, self.tcp_conn), daemon=True).start()
+        elif cmd["action"] == "rider_info":
+            info = json.loads(cmd["data"])
+            self.riders[info["tp_id"]] = info
+        elif cmd["action"] == "rider_status_update" and self.rider_status_cb is not None:
+            self.on_rider_status(json.loads(cmd["data"]))
+        elif cmd["action"] == "rider_status_delta":
+            # Only the changed fields unless "full" is set, merge into what we know
+            delta = json.loads(cmd["data"])
+            info = self.riders.setdefault(delta["tp_id"], {}) if not delta.pop("full", False) else {}
+            info.update(delta)
+            self.riders[delta["tp_id"]] = info
+            self.on_rider_status(dict(info))
+        elif cmd["action"] == "rider_status_batch":
+            # All riders changed in the last server tick, ours included
+            for info in json.loads(cmd["data"]):
+                if info["tp_id"] != self.tp_id:
+                    self.on_rider_status(info)
+        elif unsolicited:
+            dbg_log("PDU not handled: [%s]" % str(data_bytes, "utf-8"))
+        if future is not None:
+            future.set_result(cmd)
 
     def on_udp_data_recv_callback(self, data_bytes):
+        with self.udp_rx_cond:
+            payloads = self.udp_rx.receive(data_bytes, time.monotonic())
+            if self.udp_rx.jitter is not None:
+                self.udp_rx_cond.notify()
+            self.deliver_udp(payloads)
         #dbg_log("Udp data received from server, %d bytes. (XXX: Not handled.)" % len(data_bytes))
         #i = 0;
         #while i < len(data_bytes):
@@ -176,9 +765,36 @@ class Transport(object):
         #    i += 2
         pass
 
+    def deliver_udp(self, payloads):
+        if self.udp_recv_cb is not None:
+            for payload in payloads:
+                self.udp_recv_cb(payload)
+
+    def jitter_loop(self):
+        # Hands out what waited its full delay in the jitter buffer
+        with self.udp_rx_cond:
+            while self.udp_rx_running:
+                deadline = self.udp_rx.jitter.next_deadline()
+                if deadline is None:
+                    self.udp_rx_cond.wait()
+                    continue
+                now = time.monotonic()
+                if deadline > now:
+                    self.udp_rx_cond.wait(deadline - now)
+                    continue
+                self.deliver_udp(self.udp_rx.expire(now))
+
+    def udp_statistics(self):
+        # Per sender tp_id loss, reordering and jitter of "udp_seq" datagrams
+        with self.udp_rx_cond:
+            return self.udp_rx.statistics()
+
     def connect(self):
         self.tcp_conn = TcpConnection(self.svr_ip, self.svr_port, self.on_tcp_data_recv_callback)
         self.tcp_conn.start()
+        if self.udp_rx.jitter is not None and not self.udp_rx_running:
+            self.udp_rx_running = True
+            Thread(target=self.jitter_loop, daemon=True).start()
         wait_tries = 50
         while wait_tries > 0:
             if self.tcp_conn.is_connected():
@@ -186,41 +802,441 @@ class Transport(object):
             time.sleep(0.1)
             wait_tries -= 1
 
-    def send_tcp_pdu(self, action, data):
+    def heartbeat_loop(self, interval, conn):
+        # Ping once nothing was sent for interval, the server drops us after
+        # three. No pong within another interval means the server is gone.
+        while not self.heartbeat_stop.wait(interval / 2):
+            if self.tcp_conn is not conn or not conn.is_connected():
+                return
+            if time.monotonic() - conn.last_send < interval:
+                continue
+            try:
+                self.call("ping", "", interval)
+            except concurrent.futures.TimeoutError:
+                dbg_log("No pong from server in %.1fs, close the connection." % interval)
+                self.close()
+                return
+            except ConnectionError:
+                return
+
+    def send_tcp_pdu(self, action, data, req_id=None):
         cmd = {"action": action,
                "data": data
               }
-        cmd_str = json.dumps(cmd)
-        self.tcp_conn.send_data(cmd_str.encode())
+        if req_id is not None:
+            cmd["req_id"] = req_id
+        data_bytes = json.dumps(cmd).encode()
+        self.tcp_conn.send_data(data_bytes, self.wants_compressed(len(data_bytes)))
+
+    def wants_compressed(self, data_len):
+        return data_len >= COMPRESS_MIN_BYTES and "compress" in self.features
+
+    def send_request(self, action, data):
+        future = Future()
+        req_id = self.pending.add(action, future)
+        self.send_tcp_pdu(action, data, req_id)
+        return req_id, future
+
+    def request(self, action, data=""):
+        # Future resolved with the reply dict, or failed when the connection closes
+        return self.send_request(action, data)[1]
+
+    def call(self, action, data="", timeout=5):
+        # Blocking request, raises concurrent.futures.TimeoutError
+        req_id, future = self.send_request(action, data)
+        try:
+            return future.result(timeout)
+        finally:
+            self.pending.discard(req_id)
 
     def create_udp_channel(self):
-        self.send_tcp_pdu("create_udp_channel", "")
+        return self.request("create_udp_channel")
 
     def client_update_user(self, usr_info):
         self.send_tcp_pdu("update_user", usr_info)
 
+    def negotiate(self, features):
+        # Ask for optional protocol features, the server replies with the accepted ones
+        return self.request("negotiate", json.dumps({"features": list(features)}))
+
     def client_update_status(self, status_str):
+        if "binary" in self.features:
+            pdu = encode_binary_status(status_str)
+            if pdu is not None:
+                self.tcp_conn.send_data(pdu)
+                return
         self.send_tcp_pdu("update_status", status_str)
 
     def broadcast_tcp_message(self, msg_str):
         self.send_tcp_pdu("broadcast", msg_str)
 
     def list_clients(self):
-        self.send_tcp_pdu("list_clients", "")
+        # Legacy text roster
+        return self.request("list_clients")
+
+    def roster(self, scene_id=None, user_domain=None, page_size=200, timeout=5):
+        # Every client matching the filters as dicts, fetched page by page
+        query = {"limit": page_size}
+        if scene_id is not None:
+            query["scene_id"] = scene_id
+        if user_domain is not None:
+            query["user_domain"] = user_domain
+        clients = []
+        while True:
+            reply = self.call("list_clients", json.dumps(query), timeout)
+            if "error" in reply:
+                raise ServerError(reply["error"])
+            page = json.loads(reply["data"])
+            clients.extend(page["clients"])
+            if page["next_cursor"] is None:
+                return clients
+            query["cursor"] = page["next_cursor"]
+
+    def stats(self):
+        return self.request("stats")
 
     def send_tcp_data(self, data_str):
         self.send_tcp_pdu("data", data_str)
 
     def send_udp_data(self, data_bytes):
-        if self.udp_conn is None:
+        if self.udp_conn is None or not self.udp_conn.is_connected():
             dbg_log("XXX: No Udp connection yet.")
             return
         self.udp_conn.send_data(data_bytes)
 
     def close(self):
+        self.heartbeat_stop.set()
+        with self.udp_rx_cond:
+            self.udp_rx_running = False
+            self.udp_rx_cond.notify()
+        self.pending.fail_all(ConnectionError("Connection closed"))
         if self.tcp_conn is not None:
             self.tcp_conn.stop()
             self.tcp_conn = None
         if self.udp_conn is not None:
             self.udp_conn.stop()
             self.udp_conn = None
+
+#########################################################
+# asyncio client
+#
+# Same protocol as Transport without any thread, so one
+# process can drive thousands of clients. Messages are read
+# with the async iterators:
+#     tcp_messages() - JSON PDUs as dicts, {"action", "data"},
+#                      except replies to request() calls.
+#                      Binary status frames come out as
+#                      {"action": "rider_status_binary",
+#                       "data": [rider status dicts]}.
+#     udp_messages() - UDP payloads as bytes.
+# Both end when the connection is closed.
+#########################################################
+def put_latest(queue, item):
+    # Never wait on a full queue, drop its oldest message instead
+    while True:
+        try:
+            queue.put_nowait(item)
+            return
+        except asyncio.QueueFull:
+            queue.get_nowait()
+
+class AsyncUdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, recv_cb):
+        self.recv_cb = recv_cb
+
+    def datagram_received(self, data, addr):
+        self.recv_cb(data)
+
+class AsyncTransport(object):
+    PACKET_LIMIT = TcpConnection.PACKET_LIMIT
+    HEADER_LEN = TcpConnection.HEADER_LEN
+
+    # jitter_buffer as in Transport
+    def __init__(self, svr_ip, svr_port, queue_size=1024, jitter_buffer=0.0):
+        self.svr_ip = svr_ip
+        self.svr_port = svr_port
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.heartbeat_task = None
+        self.last_send = time.monotonic()
+        self.udp_transport = None
+        self.udp_port = None
+        self.udp_packer = None
+        self.udp_flush = None
+        self.udp_sequencer = None
+        self.udp_rx = UdpReceiver(jitter_buffer)
+        self.udp_expire = None
+        self.tp_id = None
+        self.features = set()
+        self.riders = {}
+        # Incoming messages, the oldest is dropped when nobody keeps up
+        self.tcp_queue = asyncio.Queue(queue_size)
+        self.udp_queue = asyncio.Queue(queue_size)
+        self.pending = PendingRequests()
+
+    async def connect(self):
+        dbg_log("Connect to communication server at %s:%d" % (self.svr_ip, self.svr_port))
+        self.reader, self.writer = await asyncio.open_connection(self.svr_ip, self.svr_port)
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(self.HEADER_LEN)
+                lens = int.from_bytes(header, byteorder="little")
+                compressed = lens & COMPRESSED_FLAG
+                lens &= ~COMPRESSED_FLAG
+                if lens > self.PACKET_LIMIT:
+                    raise FrameError("Frame length %d over limit" % lens)
+                data_bytes = await self.reader.readexactly(lens)
+                if compressed:
+                    data_bytes = inflate(data_bytes, self.PACKET_LIMIT)
+                await self.on_tcp_data(data_bytes)
+        except asyncio.IncompleteReadError:
+            dbg_log("Connnection closed by peer, quit this connection.")
+        except (OSError, FrameError) as e:
+            dbg_log("Socket recv exception: %s" % str(e))
+        finally:
+            if self.heartbeat_task is not None:
+                self.heartbeat_task.cancel()
+                self.heartbeat_task = None
+            self.pending.fail_all(ConnectionError("Connection closed"))
+            put_latest(self.tcp_queue, None)
+            self.close_udp()
+            put_latest(self.udp_queue, None)
+
+    async def on_tcp_data(self, data_bytes):
+        if data_bytes and data_bytes[0] == BIN_MAGIC:
+            cmd = {
+                "action": "rider_status_binary",
+                "data": decode_binary_status(data_bytes, self.riders, self.tp_id)
+            }
+            put_latest(self.tcp_queue, cmd)
+            return
+        cmd = json.loads(str(data_bytes, "utf-8"))
+        future = self.pending.pop(cmd)
+        if cmd["action"] == "rejected":
+            dbg_log("Connection rejected by server: %s" % cmd["data"])
+            self.pending.fail_all(ConnectionRefusedError(cmd["data"]))
+        elif cmd["action"] == "create_udp_channel" and "error" not in cmd:
+            await self.open_udp(int(cmd["data"]), cmd.get("token"))
+        elif cmd["action"] == "negotiate":
+            reply = json.loads(cmd["data"])
+            self.tp_id = reply["tp_id"]
+            self.features = set(reply["features"])
+            self.udp_rx.seq = "udp_seq" in self.features
+            self.udp_rx.pack = "udp_pack" in self.features
+            if "heartbeat" in self.features and reply.get("idle_timeout") and self.heartbeat_task is None:
+                self.heartbeat_task = asyncio.ensure_future(self.heartbeat(reply["idle_timeout"] / 3.0))
+        elif cmd["action"] == "rider_info":
+            info = json.loads(cmd["data"])
+            self.riders[info["tp_id"]] = info
+        if future is not None:
+            if not future.done():
+                future.set_result(cmd)
+            return
+        if "req_id" in cmd:
+            # Late reply to a request that timed out
+            return
+        put_latest(self.tcp_queue, cmd)
+
+    async def open_udp(self, port, token):
+        # Also called again when the server moved us to another worker
+        self.close_udp()
+        self.udp_port = port
+        self.udp_sequencer = UdpSequencer(self.tp_id) if "udp_seq" in self.features else None
+        self.udp_packer = UdpPacker(self.udp_payload_limit()) if "udp_pack" in self.features else None
+        loop = asyncio.get_running_loop()
+        self.udp_transport, protocol = await loop.create_datagram_endpoint(
+            lambda: AsyncUdpProtocol(self.on_udp_data), remote_addr=(self.svr_ip, port))
+        self.udp_transport.sendto(UDP_HELLO if token is None else UDP_HELLO_PREFIX + token.encode())
+
+    def udp_payload_limit(self):
+        return UdpConnection.PACKET_LIMIT - (UDP_SEQ_HEADER.size if self.udp_sequencer else 0)
+
+    def send_datagram(self, datagram):
+        if self.udp_sequencer is not None:
+            datagram = self.udp_sequencer.stamp(datagram)
+        self.udp_transport.sendto(datagram)
+
+    def on_udp_data(self, data_bytes):
+        for payload in self.udp_rx.receive(data_bytes, time.monotonic()):
+            put_latest(self.udp_queue, payload)
+        self.schedule_expire()
+
+    def schedule_expire(self):
+        if self.udp_rx.jitter is None or self.udp_expire is not None:
+            return
+        deadline = self.udp_rx.jitter.next_deadline()
+        if deadline is not None:
+            loop = asyncio.get_running_loop()
+            self.udp_expire = loop.call_later(max(0.0, deadline - time.monotonic()), self.expire_udp)
+
+    def expire_udp(self):
+        self.udp_expire = None
+        for payload in self.udp_rx.expire(time.monotonic()):
+            put_latest(self.udp_queue, payload)
+        self.schedule_expire()
+
+    def udp_statistics(self):
+        # As Transport.udp_statistics
+        return self.udp_rx.statistics()
+
+    def flush_udp(self):
+        self.udp_flush = None
+        if self.udp_transport is not None and self.udp_packer is not None:
+            for datagram in self.udp_packer.take():
+                self.send_datagram(datagram)
+
+    def close_udp(self):
+        if self.udp_transport is not None:
+            self.flush_udp()
+            self.udp_transport.close()
+            self.udp_transport = None
+        if self.udp_flush is not None:
+            self.udp_flush.cancel()
+            self.udp_flush = None
+        if self.udp_expire is not None:
+            self.udp_expire.cancel()
+            self.udp_expire = None
+
+    async def request(self, action, data="", timeout=5):
+        # The reply dict, raises asyncio.TimeoutError
+        future = asyncio.get_running_loop().create_future()
+        req_id = self.pending.add(action, future)
+        self.send_tcp_pdu(action, data, req_id)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.discard(req_id)
+
+    def send_data(self, data_bytes, compress=False):
+        self.writer.write(make_frame(data_bytes, self.PACKET_LIMIT, self.HEADER_LEN, compress))
+        self.last_send = time.monotonic()
+
+    async def heartbeat(self, interval):
+        # Same as Transport.heartbeat_loop
+        while True:
+            await asyncio.sleep(interval / 2)
+            if time.monotonic() - self.last_send < interval:
+                continue
+            try:
+                await self.request("ping", "", interval)
+            except asyncio.TimeoutError:
+                dbg_log("No pong from server in %.1fs, close the connection." % interval)
+                self.writer.close()
+                return
+            except ConnectionError:
+                return
+
+    def wants_compressed(self, data_len):
+        return data_len >= COMPRESS_MIN_BYTES and "compress" in self.features
+
+    def send_tcp_pdu(self, action, data, req_id=None):
+        cmd = {"action": action,
+               "data": data
+              }
+        if req_id is not None:
+            cmd["req_id"] = req_id
+        data_bytes = json.dumps(cmd).encode()
+        self.send_data(data_bytes, self.wants_compressed(len(data_bytes)))
+
+    async def drain(self):
+        # Wait until the TCP write buffer is below its high-water mark
+        await self.writer.drain()
+
+    async def create_udp_channel(self, timeout=5):
+        # Returns the server UDP port once the channel is up
+        await self.request("create_udp_channel", "", timeout)
+        return self.udp_port
+
+    async def negotiate(self, features, timeout=5):
+        # Returns the features the server accepted
+        await self.request("negotiate", json.dumps({"features": list(features)}), timeout)
+        return self.features
+
+    def client_update_user(self, usr_info):
+        self.send_tcp_pdu("update_user", usr_info)
+
+    def client_update_status(self, status_str):
+        if "binary" in self.features:
+            pdu = encode_binary_status(status_str)
+            if pdu is not None:
+                self.send_data(pdu)
+                return
+        self.send_tcp_pdu("update_status", status_str)
+
+    def broadcast_tcp_message(self, msg_str):
+        self.send_tcp_pdu("broadcast", msg_str)
+
+    async def list_clients(self, timeout=5):
+        # Legacy text roster
+        return (await self.request("list_clients", "", timeout))["data"]
+
+    async def roster(self, scene_id=None, user_domain=None, page_size=200, timeout=5):
+        # Every client matching the filters as dicts, fetched page by page
+        query = {"limit": page_size}
+        if scene_id is not None:
+            query["scene_id"] = scene_id
+        if user_domain is not None:
+            query["user_domain"] = user_domain
+        clients = []
+        while True:
+            reply = await self.request("list_clients", json.dumps(query), timeout)
+            if "error" in reply:
+                raise ServerError(reply["error"])
+            page = json.loads(reply["data"])
+            clients.extend(page["clients"])
+            if page["next_cursor"] is None:
+                return clients
+            query["cursor"] = page["next_cursor"]
+
+    async def stats(self, timeout=5):
+        return json.loads((await self.request("stats", "", timeout))["data"])
+
+    def send_udp_data(self, data_bytes):
+        if self.udp_transport is None:
+            dbg_log("XXX: No Udp connection yet.")
+            return
+        data_bytes = data_bytes[:self.udp_payload_limit()]
+        if self.udp_packer is None:
+            self.send_datagram(data_bytes)
+            return
+        for datagram in self.udp_packer.add(data_bytes):
+            self.send_datagram(datagram)
+        if not self.udp_packer.pending():
+            if self.udp_flush is not None:
+                self.udp_flush.cancel()
+                self.udp_flush = None
+        elif self.udp_flush is None:
+            self.udp_flush = asyncio.get_running_loop().call_later(UDP_FLUSH_SECONDS, self.flush_udp)
+
+    async def tcp_messages(self):
+        while True:
+            cmd = await self.tcp_queue.get()
+            if cmd is None:
+                return
+            yield cmd
+
+    async def udp_messages(self):
+        while True:
+            data_bytes = await self.udp_queue.get()
+            if data_bytes is None:
+                return
+            yield data_bytes
+
+    async def close(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+        if self.read_task is not None:
+            await self.read_task
+            self.read_task = None
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# Replays an atto-comm traffic capture (CAPTURE_PATH) against a server.
+#
+# Every captured client gets its own connection, opened and closed where the
+# capture has them, and sends what it sent back then: the same TCP frames and
+# UDP datagrams, so requests, features and UDP channels are set up the same
+# way. UDP waits up to UDP_WAIT_SECONDS for a requested channel to come up,
+# UDP of clients without one is counted as skipped. --speed 1 keeps the
+# recorded timing, 2 twice as fast, 0 replays as fast as possible.
+# --start/--end pick a window, in seconds from the capture start, found
+# through the capture index. Results are appended as one JSON
+# line per run to --output like bench.py, --compare prints this run next to
+# the previous one.
+#
+#   python replay.py atto-comm.cap 127.0.0.1 2021 --speed 1 --server-pid 1234
+import argparse
+import asyncio
+import bisect
+import json
+import mmap
+import struct
+import sys
+import time
+
+import libpyclient
+from libpyclient import AsyncTransport
+from bench import load_previous, print_compare, read_proc
+
+# Capture file format, see atto-comm.py
+CAPTURE_MAGIC = b"ATTOCAP1"
+CAPTURE_INDEX_MAGIC = b"ATTOIDX1"
+CAPTURE_HEADER = struct.Struct("<8sd")
+CAPTURE_RECORD = struct.Struct("<QIIB3x")
+CAPTURE_INDEX_ENTRY = struct.Struct("<QQ")
+CAPTURE_TRAILER = struct.Struct("<QQ8s")
+CAPTURE_TCP = 0
+CAPTURE_UDP = 1
+CAPTURE_CONNECT = 2
+CAPTURE_CLOSE = 3
+
+UDP_WAIT_SECONDS = 1.0
+
+class CaptureFile(object):
+    # Read only mmap of a capture file. A file without index (the server
+    # didn't stop cleanly) is scanned once instead, up to its last whole
+    # record.
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.started = CAPTURE_HEADER.unpack_from(self.map)
+        if magic != CAPTURE_MAGIC:
+            raise ValueError("Not an atto-comm capture: %s" % path)
+        # Records end at self.end, index is [(time_us, offset)] in time order
+        self.end, self.index = self.load_index()
+        self.index_times = [t_us for t_us, offset in self.index]
+
+    def load_index(self):
+        size = len(self.map)
+        if size >= CAPTURE_HEADER.size + CAPTURE_TRAILER.size:
+            offset, entries, magic = CAPTURE_TRAILER.unpack_from(self.map, size - CAPTURE_TRAILER.size)
+            if magic == CAPTURE_INDEX_MAGIC and offset + entries * CAPTURE_INDEX_ENTRY.size + CAPTURE_TRAILER.size == size:
+                index = [CAPTURE_INDEX_ENTRY.unpack_from(self.map, offset + i * CAPTURE_INDEX_ENTRY.size)
+                         for i in range(entries)]
+                return offset, index
+        index = []
+        pos = CAPTURE_HEADER.size
+        while pos + CAPTURE_RECORD.size <= size:
+            t_us, tp_id, length, channel = CAPTURE_RECORD.unpack_from(self.map, pos)
+            if pos + CAPTURE_RECORD.size + length > size:
+                break
+            index.append((t_us, pos))
+            pos += CAPTURE_RECORD.size + length
+        return pos, index
+
+    def records(self, start_us=0, end_us=None):
+        # (time_us, channel, tp_id, data) with start_us <= time_us < end_us
+        # Times can tie, start at the entry before the first one at start_us
+        i = bisect.bisect_left(self.index_times, start_us) - 1
+        pos = self.index[max(i, 0)][1] if self.index else self.end
+        while pos < self.end:
+            t_us, tp_id, length, channel = CAPTURE_RECORD.unpack_from(self.map, pos)
+            data_start = pos + CAPTURE_RECORD.size
+            pos = data_start + length
+            if t_us < start_us:
+                continue
+            if end_us is not None and t_us >= end_us:
+                return
+            yield t_us, channel, tp_id, self.map[data_start:pos]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class Replayer(object):
+    def __init__(self, args):
+        self.args = args
+        # Captured tp_id -> AsyncTransport
+        self.clients = {}
+        # Captured tp_ids that sent create_udp_channel
+        self.udp_requested = set()
+        self.records = 0
+        self.connections = 0
+        self.tcp_frames = 0
+        self.tcp_bytes = 0
+        self.udp_datagrams = 0
+        self.udp_bytes = 0
+        self.udp_skipped = 0
+        self.errors = 0
+
+    async def client(self, tp_id):
+        # Clients connected before the replayed window show up on their first record
+        tp = self.clients.get(tp_id)
+        if tp is None:
+            tp = AsyncTransport(self.args.svr_ip, self.args.svr_port)
+            await tp.connect()
+            self.clients[tp_id] = tp
+            self.connections += 1
+        return tp
+
+    async def close(self, tp_id):
+        self.udp_requested.discard(tp_id)
+        tp = self.clients.pop(tp_id, None)
+        if tp is not None:
+            await tp.close()
+
+    async def replay(self, t_us, channel, tp_id, data):
+        self.records += 1
+        if channel == CAPTURE_CLOSE:
+            await self.close(tp_id)
+            return
+        tp = await self.client(tp_id)
+        if channel == CAPTURE_TCP:
+            tp.send_data(data, tp.wants_compressed(len(data)))
+            self.tcp_frames += 1
+            self.tcp_bytes += len(data)
+            if b'"create_udp_channel"' in data:
+                self.udp_requested.add(tp_id)
+            await tp.drain()
+        elif channel == CAPTURE_UDP:
+            if tp.udp_transport is None and tp_id in self.udp_requested:
+                await self.wait_udp(tp)
+            if tp.udp_transport is None:
+                self.udp_skipped += 1
+                return
+            tp.udp_transport.sendto(data)
+            self.udp_datagrams += 1
+            self.udp_bytes += len(data)
+
+    async def wait_udp(self, tp):
+        # Replaying faster than recorded outruns the create_udp_channel reply
+        deadline = time.monotonic() + UDP_WAIT_SECONDS
+        while tp.udp_transport is None and not tp.read_task.done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.001)
+
+    async def close_all(self):
+        for tp_id in list(self.clients):
+            await self.close(tp_id)
+
+async def replay_capture(args):
+    libpyclient.debugging_on = args.verbose
+    capture = CaptureFile(args.capture)
+    replayer = Replayer(args)
+    start_us = int(args.start * 1000000)
+    end_us = int(args.end * 1000000) if args.end else None
+    proc_start = read_proc(args.server_pid) if args.server_pid else None
+    print("Replaying %s (captured %s) at %s speed......" % (
+        args.capture, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(capture.started)),
+        "%gx" % args.speed if args.speed > 0 else "full"))
+
+    t_start = time.monotonic()
+    first_us = None
+    max_lag = 0.0
+    for t_us, channel, tp_id, data in capture.records(start_us, end_us):
+        if args.speed > 0:
+            if first_us is None:
+                first_us = t_us
+            delay = t_start + (t_us - first_us) / 1000000.0 / args.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+        try:
+            await replayer.replay(t_us, channel, tp_id, data)
+        except (OSError, ConnectionError) as e:
+            replayer.errors += 1
+            if args.verbose:
+                print("Replay to client %d failed: %s" % (tp_id, str(e)))
+    elapsed = time.monotonic() - t_start
+    proc_end = read_proc(args.server_pid) if args.server_pid else None
+    # Let the server work through what was sent before hanging up
+    await asyncio.sleep(args.drain)
+    await replayer.close_all()
+    capture.close()
+
+    result = {
+        "label": args.label,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {
+            "capture": args.capture,
+            "speed": args.speed,
+            "start": args.start,
+            "end": args.end
+        },
+        "elapsed_s": round(elapsed, 3),
+        "records": replayer.records,
+        "records_per_s": round(replayer.records / elapsed, 1) if elapsed > 0 else None,
+        "connections": replayer.connections,
+        "tcp_frames": replayer.tcp_frames,
+        "tcp_mbit": round(replayer.tcp_bytes * 8 / elapsed / 1e6, 3) if elapsed > 0 else None,
+        "udp_datagrams": replayer.udp_datagrams,
+        "udp_mbit": round(replayer.udp_bytes * 8 / elapsed / 1e6, 3) if elapsed > 0 else None,
+        "udp_skipped": replayer.udp_skipped,
+        "errors": replayer.errors,
+        "max_lag_ms": round(max_lag * 1000.0, 3)
+    }
+    if proc_start and proc_end and elapsed > 0:
+        result["server_cpu_pct"] = round((proc_end[0] - proc_start[0]) / elapsed * 100.0, 1)
+        result["server_rss_mb"] = round(proc_end[1] / 1e6, 1)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="atto-comm capture replay")
+    parser.add_argument("capture")
+    parser.add_argument("svr_ip", nargs="?", default="127.0.0.1")
+    parser.add_argument("svr_port", nargs="?", type=int, default=2021)
+    parser.add_argument("--speed", type=float, default=1.0, help="1 is the recorded timing, 0 as fast as possible")
+    parser.add_argument("--start", type=float, default=0.0, help="seconds from the capture start")
+    parser.add_argument("--end", type=float, default=0.0, help="seconds from the capture start, 0 to the end")
+    parser.add_argument("--drain", type=float, default=1.0)
+    parser.add_argument("--server-pid", type=int, default=0, help="sample server CPU and RSS from /proc")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output", default="replay_results.jsonl", help="results are appended here")
+    parser.add_argument("--compare", action="store_true", help="compare with the last run in --output")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    result = asyncio.run(replay_capture(args))
+    previous = load_previous(args.output) if args.compare else None
+    print(json.dumps(result, indent=2))
+    with open(args.output, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    if previous is not None:
+        print_compare(previous, result)
+    sys.exit(0)